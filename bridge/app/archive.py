@@ -0,0 +1,150 @@
+# Background archival of session data into data_collection/.
+#
+# A GCS rename is a copy plus a delete, doing that blob by blob inside a request made ending a
+# large session take seconds. Instead:
+# - images the desktop acknowledged are deleted with their manifest entries in batched deletes,
+#   unless the session is sampled for data collection
+# - ending a connection hands the remaining blobs and the connection document to a background
+#   job which downloads them concurrently, writes one bundle for the whole session and batch
+#   deletes the originals
+#
+# Jobs run on this instance after the response went out, on Cloud Run that needs CPU to stay
+# allocated outside of requests (--no-cpu-throttling, set in .github/workflows/deploy.yml) for them
+# to make progress.
+#
+# Sampling is decided per session from a hash of the connection id, so every bundle of a session
+# agrees on whether it is kept.
+import hashlib
+import json
+import logging
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Iterable
+from manifest import all_entries
+
+ARCHIVE_PREFIX = "data_collection"
+# XXX: keep 100% of sessions for analysis and improvement right now, drop to 0.1-0.2 after we go live
+ARCHIVE_SAMPLE_RATE = float(os.getenv("ARCHIVE_SAMPLE_RATE", "1.0"))
+ARCHIVE_JOB_WORKERS = int(os.getenv("ARCHIVE_JOB_WORKERS", "2"))
+ARCHIVE_IO_WORKERS = int(os.getenv("ARCHIVE_IO_WORKERS", "16"))
+GCS_BATCH_SIZE = 100  # max number of calls in one GCS batch request
+FIRESTORE_BATCH_SIZE = 500  # max writes in one Firestore batch
+
+
+def is_sampled(connection_id: str, sample_rate: float) -> bool:
+    digest = hashlib.sha256(connection_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 < sample_rate
+
+
+class Archiver:
+    def __init__(
+        self,
+        storage_client,
+        bucket,
+        db,
+        sample_rate: float = ARCHIVE_SAMPLE_RATE,
+        job_workers: int = ARCHIVE_JOB_WORKERS,
+        io_workers: int = ARCHIVE_IO_WORKERS,
+    ):
+        self.storage_client = storage_client
+        self.bucket = bucket
+        self.db = db
+        self.sample_rate = sample_rate
+        # jobs and the downloads they fan out to use separate pools so jobs can't starve each other
+        self._jobs = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix="archive-job")
+        self._io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="archive-io")
+
+    def is_sampled(self, connection_id: str) -> bool:
+        return is_sampled(connection_id, self.sample_rate)
+
+    def archive_connection(self, connection_id: str, doc: dict) -> None:
+        self._jobs.submit(self._archive_connection, connection_id, doc)
+
+    def discard(self, blobs: Iterable, manifest_entries: Iterable = ()) -> None:
+        self._jobs.submit(self._discard, list(blobs), list(manifest_entries))
+
+    def delete_blobs(self, blobs: Iterable) -> None:
+        blobs = list(blobs)
+        for i in range(0, len(blobs), GCS_BATCH_SIZE):
+            try:
+                with self.storage_client.batch(raise_exception=False):
+                    for blob in blobs[i : i + GCS_BATCH_SIZE]:
+                        blob.delete()
+            except Exception as e:
+                logging.error(f"Error deleting blobs: {e}")
+
+    def delete_documents(self, refs: Iterable) -> None:
+        refs = list(refs)
+        for i in range(0, len(refs), FIRESTORE_BATCH_SIZE):
+            try:
+                batch = self.db.batch()
+                for ref in refs[i : i + FIRESTORE_BATCH_SIZE]:
+                    batch.delete(ref)
+                batch.commit()
+            except Exception as e:
+                logging.error(f"Error deleting documents: {e}")
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._jobs.shutdown(wait=wait)
+        self._io.shutdown(wait=wait)
+
+    def _bundle_name(self, connection_id: str, label: str) -> str:
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        return f"{ARCHIVE_PREFIX}/{connection_id}/{label}-{timestamp}.zip"
+
+    def _upload_bundle(self, connection_id: str, label: str, bundle: bytes) -> bool:
+        try:
+            self.bucket.blob(self._bundle_name(connection_id, label)).upload_from_string(
+                bundle, content_type="application/zip"
+            )
+            return True
+        except Exception as e:
+            logging.error(f"Error archiving bundle for {connection_id}/{label}: {e}")
+            return False
+
+    def _discard(self, blobs: list, manifest_entries: list) -> None:
+        self.delete_blobs(blobs)
+        self.delete_documents(entry.reference for entry in manifest_entries)
+
+    def _archive_connection(self, connection_id: str, doc: dict) -> None:
+        logging.info(f"Archiving connection {connection_id}")
+        sampled = self.is_sampled(connection_id)
+        try:
+            blobs = list(self.bucket.list_blobs(prefix=f"{connection_id}/"))
+
+            if sampled:
+                self.db.collection(ARCHIVE_PREFIX).document(connection_id).set(doc)
+
+            if sampled and blobs:
+                archived = []
+                with BytesIO() as bundle:
+                    with zipfile.ZipFile(bundle, mode="w") as zip_file:
+                        zip_file.writestr("connection.json", json.dumps(doc, default=str))
+                        for blob, data in zip(blobs, self._io.map(_download, blobs)):
+                            if data is not None:
+                                zip_file.writestr(blob.name.removeprefix(f"{connection_id}/"), data)
+                                archived.append(blob)
+                    uploaded = self._upload_bundle(connection_id, "end", bundle.getvalue())
+                # anything that failed to download or upload is left in place rather than lost
+                blobs = archived if uploaded else []
+
+            self.delete_blobs(blobs)
+            # the manifest subcollections outlive the connection document unless deleted explicitly
+            doc_ref = self.db.collection("connections").document(connection_id)
+            self.delete_documents(entry.reference for entry in all_entries(doc_ref))
+            logging.info(
+                f"Archived connection {connection_id}: {len(blobs)} blobs, sampled={sampled}"
+            )
+        except Exception as e:
+            logging.error(f"Error archiving connection {connection_id}: {e}")
+
+
+def _download(blob):
+    try:
+        return blob.download_as_bytes()
+    except Exception as e:
+        logging.error(f"Error downloading blob {blob.name}: {e}")
+        return None
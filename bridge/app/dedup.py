@@ -0,0 +1,65 @@
+# Near-duplicate detection for uploads.
+#
+# Phones that capture on a timer keep sending the same frame while they're held still. Every
+# upload gets a 64 bit difference hash (dHash: is each pixel of a 9x8 grayscale thumbnail brighter
+# than its right neighbour), which survives JPEG noise and exposure drift but changes when the
+# camera moves. The JPEG is decoded at 1/8 scale (draft) for it, so hashing a 12MP photo takes a
+# few milliseconds.
+#
+# The hashes of the last DEDUP_WINDOW stored uploads per state are kept on the connection document
+# (recent_hashes.{state}, hex strings, written in the same transaction as the manifest entry, see
+# manifest.append_image), so enqueue compares against the document it has already read. An upload
+# within DUPLICATE_DISTANCE bits of one of them is dropped before it reaches storage and the phone
+# is told to move (directive "move").
+#
+# The phone holding still isn't the only way to get a new picture, the desktop redraws the screens
+# too (the calibration board moves, organization patterns grow) and the photos before and after
+# that can be a bit or two apart. The desktop reports every redraw (POST /image_queue/scene),
+# which empties the state's window, so only an unchanged scene counts as a duplicate.
+import os
+from io import BytesIO
+from typing import Iterable, Optional
+
+HASH_SIZE = 8  # 8x8 comparisons => 64 bits
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "8"))
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", "4"))  # bits, 0 disables deduplication
+
+
+def perceptual_hash(image_bytes: bytes) -> Optional[str]:
+    """dHash of an image as 16 hex digits, None when it can't be decoded."""
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            thumbnail = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    pixels = thumbnail.tobytes()
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{bits:016x}"
+
+
+def recent_hashes(doc: dict, state: str) -> list[str]:
+    return (doc.get("recent_hashes") or {}).get(state, [])
+
+
+def clear_recent_hashes(state: str) -> dict:
+    """The connection document update starting a new scene, see POST /image_queue/scene."""
+    return {f"recent_hashes.{state}": []}
+
+
+def find_duplicate(image_hash: Optional[str], hashes: Iterable[str]) -> Optional[str]:
+    """The first of hashes within DUPLICATE_DISTANCE bits of image_hash."""
+    if image_hash is None or DUPLICATE_DISTANCE <= 0:
+        return None
+    value = int(image_hash, 16)
+    for other in hashes:
+        if (value ^ int(other, 16)).bit_count() <= DUPLICATE_DISTANCE:
+            return other
+    return None
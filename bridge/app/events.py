@@ -0,0 +1,293 @@
+# Wakes long-polling requests when something happens on a connection, and hands out short
+# per-connection leases so two requests (possibly on different instances) don't do the same work.
+#
+# Endpoints on this process publish directly after they change a connection, local waiters are
+# woken right away and the backend carries the notification to the other instances:
+# - local: single process, nothing leaves the instance (uvicorn on a laptop, one Cloud Run instance)
+# - firestore: changes made on other instances are picked up through a snapshot listener on the
+#   connection document, which is only kept open while a request here is waiting on it. Leases are
+#   documents in the leases collection with an expires_at, an expired one is free to take and the
+#   sweeper deletes those a crashed holder left behind.
+# - redis: notifications go through PUBLISH on one pattern subscription per instance, leases are
+#   SET NX PX keys. Works against anything Redis-compatible, e.g. a local redis/valkey container
+#   for tests, or pass a fakeredis client to RedisBackend.
+# Select with EVENTS_BACKEND=local|firestore|redis (and REDIS_URL).
+#
+# Waiters always re-check the document after subscribing and after every wake-up, a notification
+# only means "something may have changed", so spurious or coalesced wake-ups are harmless.
+# Nothing is shared between connections, so adding instances adds throughput.
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Optional
+from google.cloud import firestore
+
+MAX_WAIT_SECONDS = 25.0  # well below the Cloud Run request timeout
+LEASE_TTL_SECONDS = 120.0  # a crashed holder blocks the connection for at most this long
+LEASE_RETRY_SECONDS = (0.05, 0.5)  # backoff between attempts while waiting for a lease
+EVENTS_BACKEND = os.environ.get("EVENTS_BACKEND", "firestore")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL_PREFIX = "display-organizer:connection:"
+REDIS_LEASE_PREFIX = "display-organizer:lease:"
+LEASE_COLLECTION = "leases"  # firestore backend, expired documents are deleted by sweeper.py
+
+
+class Subscription:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def notify(self) -> None:
+        # publishers can be on any thread, e.g. the Firestore listener's
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+class Lease:
+    def __init__(self, backend: "LocalBackend", key: str, token: str):
+        self.backend = backend
+        self.key = key
+        self.token = token
+        self._released = False
+
+    def release(self) -> None:
+        # sync and idempotent, it's called from the threadpool that streams responses
+        if self._released:
+            return
+        self._released = True
+        try:
+            self.backend.release(self.key, self.token)
+        except Exception as e:
+            # expires on its own after LEASE_TTL_SECONDS
+            logging.error(f"Could not release lease {self.key}: {e}")
+
+
+class LocalBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases: dict[str, tuple[str, float]] = {}
+
+    def start(self, deliver: Callable[[str], None]) -> None:
+        # deliver(connection_id) wakes this instance's waiters for notifications from other instances
+        pass
+
+    def publish(self, connection_id: str) -> None:
+        pass
+
+    def watch(self, connection_id: str) -> Optional[Callable[[], None]]:
+        # per-connection listener kept while this instance has waiters, returns how to stop it
+        return None
+
+    def try_acquire(self, key: str, token: str, ttl: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            holder = self._leases.get(key)
+            if holder and holder[1] > now:
+                return False
+            self._leases[key] = (token, now + ttl)
+            return True
+
+    def release(self, key: str, token: str) -> None:
+        with self._lock:
+            if self._leases.get(key, ("",))[0] == token:
+                del self._leases[key]
+
+    def close(self) -> None:
+        pass
+
+
+class FirestoreBackend(LocalBackend):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self._deliver: Callable[[str], None] = lambda _: None
+
+    def start(self, deliver: Callable[[str], None]) -> None:
+        self._deliver = deliver
+
+    def watch(self, connection_id: str) -> Optional[Callable[[], None]]:
+        watch = (
+            self.db.collection("connections")
+            .document(connection_id)
+            .on_snapshot(lambda *_: self._deliver(connection_id))
+        )
+        return watch.unsubscribe
+
+    def try_acquire(self, key: str, token: str, ttl: float) -> bool:
+        lease_ref = self.db.collection(LEASE_COLLECTION).document(key.replace("/", ":"))
+
+        @firestore.transactional
+        def acquire(transaction) -> bool:
+            now = datetime.now(timezone.utc)
+            holder = lease_ref.get(transaction=transaction)
+            if holder.exists and holder.to_dict().get("expires_at") > now:
+                return False
+            transaction.set(lease_ref, {"token": token, "expires_at": now + timedelta(seconds=ttl)})
+            return True
+
+        return acquire(self.db.transaction())
+
+    def release(self, key: str, token: str) -> None:
+        lease_ref = self.db.collection(LEASE_COLLECTION).document(key.replace("/", ":"))
+
+        @firestore.transactional
+        def release(transaction) -> None:
+            holder = lease_ref.get(transaction=transaction)
+            if holder.exists and holder.to_dict().get("token") == token:
+                transaction.delete(lease_ref)
+
+        release(self.db.transaction())
+
+
+class RedisBackend(LocalBackend):
+    def __init__(self, client=None, url: str = REDIS_URL):
+        super().__init__()
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self._pubsub = None
+        self._thread = None
+
+    def start(self, deliver: Callable[[str], None]) -> None:
+        def handle(message) -> None:
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            deliver(channel[len(REDIS_CHANNEL_PREFIX):])
+
+        # one pattern subscription per instance instead of one per waited-on connection
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.psubscribe(**{f"{REDIS_CHANNEL_PREFIX}*": handle})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def publish(self, connection_id: str) -> None:
+        self.client.publish(f"{REDIS_CHANNEL_PREFIX}{connection_id}", b"")
+
+    def try_acquire(self, key: str, token: str, ttl: float) -> bool:
+        return bool(self.client.set(f"{REDIS_LEASE_PREFIX}{key}", token, nx=True, px=int(ttl * 1000)))
+
+    def release(self, key: str, token: str) -> None:
+        import redis
+
+        # compare-and-delete without Lua so Redis-compatible stand-ins without scripting work too
+        key = f"{REDIS_LEASE_PREFIX}{key}"
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                holder = pipe.get(key)
+                if holder is not None and holder.decode() == token:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+            except redis.WatchError:
+                # changed under us, so it's no longer ours
+                pass
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._thread.stop()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+
+def make_backend(db, name: str = EVENTS_BACKEND) -> LocalBackend:
+    if name == "local":
+        return LocalBackend()
+    if name == "firestore":
+        return FirestoreBackend(db)
+    if name == "redis":
+        return RedisBackend()
+    raise ValueError(f"Unknown EVENTS_BACKEND {name}, expected local, firestore or redis")
+
+
+class EventBus:
+    def __init__(self, backend: LocalBackend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._watches: dict[str, Callable[[], None]] = {}
+        backend.start(self._notify)
+
+    def publish(self, connection_id: str) -> None:
+        self._notify(connection_id)
+        try:
+            self.backend.publish(connection_id)
+        except Exception as e:
+            # waiters on other instances still wake up when their wait runs out
+            logging.error(f"Could not publish change of connection {connection_id}: {e}")
+
+    def _notify(self, connection_id: str) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(connection_id, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    @asynccontextmanager
+    async def subscribe(self, connection_id: str) -> AsyncIterator[Subscription]:
+        subscription = Subscription(asyncio.get_running_loop())
+        # the listener is started and handed back under the lock so a quick unsubscribe/subscribe
+        # on the same connection can't leak a listener or leave a waiter without one
+        with self._lock:
+            if connection_id not in self._subscriptions:
+                self._watch(connection_id)
+            self._subscriptions.setdefault(connection_id, set()).add(subscription)
+
+        try:
+            yield subscription
+        finally:
+            stop = None
+            with self._lock:
+                subscriptions = self._subscriptions.get(connection_id, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self._subscriptions.pop(connection_id, None)
+                    stop = self._watches.pop(connection_id, None)
+            # outside the lock, stopping the listener may wait for a callback that needs it
+            if stop is not None:
+                stop()
+
+    def _watch(self, connection_id: str) -> None:
+        try:
+            stop = self.backend.watch(connection_id)
+        except Exception as e:
+            # still woken by changes made on this instance
+            logging.error(f"Could not watch connection {connection_id}: {e}")
+            return
+        if stop is not None:
+            self._watches[connection_id] = stop
+
+    async def acquire_lease(
+        self, key: str, timeout: float = 0, ttl: float = LEASE_TTL_SECONDS
+    ) -> Optional[Lease]:
+        """Lease on key, waiting up to timeout seconds for the current holder. None if still held."""
+        token = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = LEASE_RETRY_SECONDS[0]
+        while True:
+            if self.backend.try_acquire(key, token, ttl):
+                return Lease(self.backend, key, token)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, LEASE_RETRY_SECONDS[1])
+
+    def close(self) -> None:
+        self.backend.close()
@@ -3,19 +3,36 @@
 # - creates a new connection and returns its UUID
 # POST /join_connection(UUID) => success | failure
 # - joins an existing connection with the given UUID, ran from the mobile app
-# GET /is_mobile_connected(UUID) => success | failure
+# GET /is_mobile_connected(UUID, wait) => success | failure
 # POST /send_image(UUID, image) => success more | success done | failure
 # - sends an image to the given connection UUID, ran from the desktop app
-# POST /empty_image_queue(UUID) => [images] | failure
+# POST /empty_image_queue(UUID, wait) => [images] | failure
 # - empties the image queue for the given connection UUID, ran from the desktop app
+# POST /image_queue/ack(UUID, state, seq) => success | failure
+# - acknowledges every image up to seq so it is not sent again, ran from the desktop app
+# POST /image_queue/scene(UUID, state) => success | failure
+# - the desktop changed what's on screen, photos matching the ones before it aren't duplicates
 # POST /change_state(UUID, state) => success | failure
 # - changes the state of the given connection UUID, ran from the desktop app
 # - state: new | calibrating | organizing | done
 # POST /end_connection(UUID) => success | failure
 # - ends the connection with the given UUID, ran from the mobile app
+# POST /sweep_expired_connections => sweep stats
+# - expires connections that were abandoned without end_connection and leases left by crashed
+#   holders, ran from Cloud Scheduler
+
+# `wait` turns a GET into a long-poll that returns as soon as something changes, see events.py
+# POST /image_queue tells the phone to slow down or pause instead of taking more than a connection's
+# rate limit or queue depth allows, see ratelimit.py
+# POST /image_queue drops near-duplicates of the last uploads and tells the phone to move, see dedup.py
+# GET /image_queue negotiates the image format it sends (original, JPEG/WebP/AVIF re-encodes,
+# grayscale, max edge length), see transfer.py
+# EVENTS_BACKEND picks how instances wake each other and share per-connection leases, see events.py
 
 # STATES: new | connected | calibrating | organizing | done
 
+import asyncio
+from contextlib import asynccontextmanager
 from io import BytesIO
 import base64
 import logging
@@ -25,6 +42,7 @@ from fastapi import (
     Depends,
     Path,
     File,
+    Header,
     Query,
     UploadFile,
     Response,
@@ -32,17 +50,36 @@ from fastapi import (
     Form
 )
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from google.cloud import storage, firestore
 import uuid
-from typing import Annotated, Iterator, Optional, Union
+from typing import Annotated, Callable, Iterator, Optional, Union
 from pydantic import BaseModel
 import zipfile
+from archive import Archiver
+from sweeper import SweepStats, connection_expiry, sweep_expired_connections
+from manifest import ack, acked_seq, append_image, last_seq, pending_images, queue_depth
+from events import MAX_WAIT_SECONDS, EventBus, Lease, make_backend
+from transfer import DerivativeCache, Transfer, negotiate
+from dedup import clear_recent_hashes, find_duplicate, perceptual_hash, recent_hashes
+from ratelimit import Throttled, upload_directive
 
 storage_client = storage.Client()
 db = firestore.Client(database="display-organizer")
 bucket = storage_client.bucket("display-organizer")
+archiver = Archiver(storage_client, bucket, db)
+events = EventBus(make_backend(db))
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # let queued archive jobs finish before the instance goes away
+    archiver.shutdown(wait=True)
+    events.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 # Dependency to check if connection exists and return the document
@@ -56,6 +93,26 @@ async def get_connection(connection_id: str):
     return doc_ref, doc
 
 
+async def wait_for_connection(
+    connection_id: str, doc_ref, wait: float, ready: Callable[[dict], bool]
+) -> dict:
+    # holds a long-poll request until ready(document) or the wait runs out, returns the latest document
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    async with events.subscribe(connection_id) as subscription:
+        while True:
+            # read after subscribing so a change in between can't be missed
+            doc = doc_ref.get()
+            if not doc.exists:
+                raise HTTPException(
+                    status_code=404, detail=f"Connection ID {connection_id} not found"
+                )
+            doc = doc.to_dict()
+            remaining = deadline - loop.time()
+            if ready(doc) or remaining <= 0 or not await subscription.wait(remaining):
+                return doc
+
+
 @app.post("/create_connection")
 async def create_connection():
     connection_id = str(uuid.uuid4())
@@ -63,6 +120,7 @@ async def create_connection():
         {
             "state": "new",
             "created_at": firestore.SERVER_TIMESTAMP,
+            "expires_at": connection_expiry(),
         }
     )
     return {"connection_id": connection_id}
@@ -81,17 +139,29 @@ async def join_connection(
             detail=f"Cannot join Connection ID {connection_id}, mobile device has already paired or connection has ended",
         )
 
-    doc_ref.update({"state": "connected"})
+    doc_ref.update({"state": "connected", "expires_at": connection_expiry()})
+    events.publish(connection_id)
 
 
 @app.get("/connected_mobile_device_id/{connection_id}")
 async def connected_mobile_device_id(
     connection_id: Annotated[str, Path()],
     connection_info: Annotated[tuple, Depends(get_connection)],
+    wait: Annotated[
+        float,
+        Query(ge=0, le=MAX_WAIT_SECONDS, description="Seconds to hold the request until a mobile device connects."),
+    ] = 0,
 ):
-    _, doc = connection_info
+    doc_ref, doc = connection_info
+    doc = doc.to_dict()
+
+    if wait and doc.get("state") == "new":
+        doc = await wait_for_connection(
+            connection_id, doc_ref, wait, lambda d: d.get("state") != "new"
+        )
+
     return {
-        "connected": doc.to_dict().get("state") not in ("new", "done"),
+        "connected": doc.get("state") not in ("new", "done"),
         "device_id": "placeholder",
     }
 
@@ -126,7 +196,8 @@ async def set_connection_state(
             detail=f"Could not change connection state from {state_from_to[0]} to {state_from_to[1]} for Connection ID {connection_id}",
         )
 
-    doc_ref.update({"state": state})
+    doc_ref.update({"state": state, "expires_at": connection_expiry()})
+    events.publish(connection_id)
 
 
 @app.post("/end_connection/{connection_id}", status_code=204)
@@ -139,20 +210,28 @@ async def end_connection(
     # if the connection is not in the done or new state, update the state to done
     # if the other edge has acknowledged the connection as done, delete it
     if doc.to_dict().get("state") not in ("new", "connected", "done"):
-        doc_ref.update({"state": "done"})
+        doc_ref.update({"state": "done", "expires_at": connection_expiry()})
     else:
-        # XXX: Keep 100% of previous data for analysis and improvement right now
-        dest = db.collection("data_collection").document(doc_ref.id)
-        dest.set(doc.to_dict())
-        for blob in bucket.list_blobs(prefix=connection_id):
-            bucket.rename_blob(blob, "data_collection/" + blob.name)
+        # the document and blobs are archived (or dropped, see ARCHIVE_SAMPLE_RATE) in the background
         doc_ref.delete()
+        archiver.archive_connection(connection_id, doc.to_dict())
+    events.publish(connection_id)
+
+
+@app.post("/sweep_expired_connections")
+def sweep_connections(
+    max_connections: Annotated[
+        int, Query(gt=0, description="Upper bound on connections expired in this run.")
+    ] = 5000,
+) -> SweepStats:
+    # run by Cloud Scheduler, see sweeper.py
+    return sweep_expired_connections(db, archiver, max_connections)
 
-        # TODO: delete 80-90% of previous data after we go live, for now keep all records as extra data
-        # delete the connection document and all associated blobs
-        # doc_ref.delete()
-        # for blob in bucket.list_blobs(prefix=connection_id):
-        #     blob.delete()
+
+MAX_DEQUEUE_LIMIT = 100
+ZIP_CHUNK_SIZE = 256 * 1024
+
+derivatives = DerivativeCache()
 
 
 class ImageUpload(BaseModel):
@@ -169,7 +248,7 @@ async def enqueue_image(
     ],
     image: Annotated[ImageUpload, Form(description="The JPEG image to send from the mobile app.")]
 ):
-    _, doc = connection_info
+    doc_ref, doc = connection_info
     current_state = doc.to_dict().get("state")
 
     if current_state == "new":
@@ -191,6 +270,14 @@ async def enqueue_image(
     if current_state != state:
         return {"directive": "next_state"}
 
+    # FastAPI has already received and parsed the whole form by now (it reads the body before
+    # resolving any dependency, so moving this into one wouldn't help), but a phone that's over
+    # its limits still shouldn't cost the decode, the hash or the storage write
+    turned_away = upload_directive(doc.to_dict(), queue_depth(doc.to_dict(), state))
+    if turned_away:
+        directive, retry_after = turned_away
+        return {"directive": directive, "retry_after": round(retry_after, 2)}
+
     if not image or ((not image.image_file or image.image_file.size == 0) and not image.image_base64):
         raise HTTPException(status_code=400, detail="No image provided")
 
@@ -203,10 +290,22 @@ async def enqueue_image(
     elif image.image_file:
         image_bytes = await image.image_file.read()
 
+    # a phone held still keeps sending the same frame, none of the copies is worth storing
+    image_hash = await asyncio.to_thread(perceptual_hash, image_bytes)
+    if find_duplicate(image_hash, recent_hashes(doc.to_dict(), state)):
+        return {"directive": "move"}
+
     image_uuid = uuid.uuid4()
 
     blob = bucket.blob(f"{connection_id}/{state}/{image_uuid}.jpg")
     blob.upload_from_string(image_bytes, content_type="image/jpeg")
+    try:
+        append_image(db, doc_ref, state, blob.name, image_hash)
+    except Throttled as e:
+        # lost the last token (or queue slot) to a concurrent upload
+        blob.delete()
+        return {"directive": e.directive, "retry_after": round(e.retry_after, 2)}
+    events.publish(connection_id)
 
     return {"directive": "more_images"}
 
@@ -218,10 +317,50 @@ async def dequeue_images(
     state: Annotated[
         str, Query(description="Only receive images associated with this state.")
     ],
+    since: Annotated[
+        Optional[int],
+        Query(
+            ge=0,
+            description="Send images with a sequence number after this cursor and wait for an explicit ack. "
+            "Without it images are sent from the acknowledged cursor and acknowledged right away.",
+        ),
+    ] = None,
+    until: Annotated[
+        Optional[int], Query(ge=0, description="Last sequence number to send, for fetching ranges in parallel.")
+    ] = None,
+    limit: Annotated[
+        Optional[int], Query(gt=0, le=MAX_DEQUEUE_LIMIT, description="Maximum number of images to send.")
+    ] = None,
+    wait: Annotated[
+        float,
+        Query(
+            ge=0,
+            le=MAX_WAIT_SECONDS,
+            description="Seconds to hold the request until an image arrives or the connection state changes.",
+        ),
+    ] = 0,
+    format: Annotated[
+        Optional[str],
+        Query(
+            description="original, jpeg, webp or avif (when this instance can encode it). "
+            "Without it the image types in the Accept header decide, original by default.",
+        ),
+    ] = None,
+    quality: Annotated[Optional[int], Query(ge=1, le=100, description="Encoder quality of re-encoded images.")] = None,
+    grayscale: Annotated[bool, Query(description="Send single channel images.")] = False,
+    max_edge: Annotated[
+        Optional[int], Query(ge=64, description="Downscale images so their longest edge is at most this.")
+    ] = None,
+    accept: Annotated[Optional[str], Header()] = None,
 ):
-    _, doc = connection_info
+    doc_ref, doc = connection_info
     doc = doc.to_dict()
 
+    try:
+        transfer = negotiate(format, quality, grayscale, max_edge, accept)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(e)) from e
+
     if doc.get("state") == "new":
         raise HTTPException(status_code=400, detail="Connection not established")
     if doc.get("state") == "done":
@@ -232,54 +371,193 @@ async def dequeue_images(
             detail="Image queue is only available for calibrating or organizing state",
         )
 
-    # return no content of no blobs with this prefix instead of sending an empty zip
-    if not next(
-        bucket.list_blobs(prefix=f"{connection_id}/{state}", max_results=1), None
-    ):
-        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    # without since the images are acknowledged as they're sent, so only one request (on any
+    # instance) may pack from the acknowledged cursor at a time. Explicit ranges are plain reads.
+    lease = None
+    if since is None:
+        started = asyncio.get_running_loop().time()
+        lease = await events.acquire_lease(f"{connection_id}/{state}/dequeue", timeout=wait)
+        # waiting for the lease counts towards the long-poll
+        wait = max(0.0, wait - (asyncio.get_running_loop().time() - started))
+        if lease is None:
+            return Response(
+                status_code=status.HTTP_204_NO_CONTENT,
+                headers={"X-Queue-Head": str(last_seq(doc, state)), "Retry-After": "1"},
+            )
 
+    try:
+        if lease:
+            # the previous holder may have acknowledged more since this request read the document
+            doc = doc_ref.get().to_dict() or doc
+        return await dequeue_entries(
+            connection_id, state, doc_ref, doc, since, until, limit, wait, lease, transfer
+        )
+    except BaseException:
+        if lease:
+            lease.release()
+        raise
+
+
+async def dequeue_entries(
+    connection_id: str,
+    state: str,
+    doc_ref,
+    doc: dict,
+    since: Optional[int],
+    until: Optional[int],
+    limit: Optional[int],
+    wait: float,
+    lease: Optional[Lease],
+    transfer: Transfer = Transfer(),
+) -> Response:
+    entries = pending_images(doc_ref, doc, state, since, until, limit or MAX_DEQUEUE_LIMIT)
+    if not entries and wait:
+        cursor = acked_seq(doc, state) if since is None else since
+        doc = await wait_for_connection(
+            connection_id,
+            doc_ref,
+            wait,
+            lambda d, current=doc.get("state"): last_seq(d, state) > cursor or d.get("state") != current,
+        )
+        entries = pending_images(doc_ref, doc, state, since, until, limit or MAX_DEQUEUE_LIMIT)
+
+    # lets the desktop split the rest of the queue into ranges without another request
     response_headers = {
-        "Content-Disposition": f"attachment; filename=images_{connection_id}.zip",
+        "X-Queue-Head": str(last_seq(doc, state)),
         "Cache-Control": "no-cache, no-store, must-revalidate",
         "Pragma": "no-cache",
         "Expires": "0",
     }
 
+    # return no content if there is nothing in the requested range instead of sending an empty zip
+    if not entries:
+        if lease:
+            lease.release()
+        return Response(status_code=status.HTTP_204_NO_CONTENT, headers=response_headers)
+
+    response_headers["Content-Disposition"] = f"attachment; filename=images_{connection_id}.zip"
+    response_headers["X-Image-Transfer"] = transfer.key
+    response_headers["Vary"] = "Accept"
+
+    # the lease is held until the images are acknowledged, released again after the response in
+    # case the client went away before the body was ever generated
     return StreamingResponse(
-        pack_images_zip(connection_id, state),
+        pack_images_zip(
+            connection_id, state, doc_ref, doc, entries, auto_ack=since is None, lease=lease, transfer=transfer
+        ),
         media_type="application/zip",
         headers=response_headers,
+        background=BackgroundTask(lease.release) if lease else None,
     )
 
 
-def pack_images_zip(connection_id: str, state: str) -> Iterator[bytes]:
+@app.post("/image_queue/{connection_id}/ack", status_code=204)
+async def acknowledge_images(
+    connection_id: Annotated[str, Path()],
+    connection_info: Annotated[tuple, Depends(get_connection)],
+    state: Annotated[
+        str, Query(description="The state of the image queue to acknowledge.")
+    ],
+    seq: Annotated[
+        int, Query(ge=0, description="Every image up to and including this sequence number was received.")
+    ],
+):
+    doc_ref, doc = connection_info
+
+    if state not in ("calibrating", "organizing"):
+        raise HTTPException(
+            status_code=400,
+            detail="Image queue is only available for calibrating or organizing state",
+        )
+    if seq > last_seq(doc.to_dict(), state):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cannot acknowledge sequence number {seq}, it has not been enqueued yet",
+        )
+
+    acknowledge(connection_id, state, doc_ref, doc.to_dict(), seq)
+
+
+@app.post("/image_queue/{connection_id}/scene", status_code=204)
+async def change_scene(
+    connection_id: Annotated[str, Path()],
+    connection_info: Annotated[tuple, Depends(get_connection)],
+    state: Annotated[
+        str, Query(description="The state whose screens the desktop just redrew.")
+    ],
+):
+    doc_ref, _ = connection_info
+
+    if state not in ("calibrating", "organizing"):
+        raise HTTPException(
+            status_code=400,
+            detail="Image queue is only available for calibrating or organizing state",
+        )
+
+    # a still phone photographing the new board or pattern must not be told to move, see dedup.py
+    doc_ref.update(clear_recent_hashes(state))
+
+
+def acknowledge(connection_id: str, state: str, doc_ref, doc: dict, seq: int) -> None:
+    previous = ack(db, doc_ref, state, seq)
+    if seq <= previous or archiver.is_sampled(connection_id):
+        # sampled sessions keep their images until end_connection archives them as one bundle
+        return
+
+    entries = pending_images(doc_ref, doc, state, since=previous, until=seq)
+    archiver.discard([bucket.blob(entry.get("blob")) for entry in entries], entries)
+
+
+def pack_images_zip(
+    connection_id: str,
+    state: str,
+    doc_ref,
+    doc: dict,
+    entries: list,
+    auto_ack: bool,
+    lease: Optional[Lease] = None,
+    transfer: Transfer = Transfer(),
+) -> Iterator[bytes]:
     logging.info(f"Starting pack_images_zip for {connection_id}/{state}")
-    blob_count = 0
+    packed = []
     try:
         with BytesIO() as zip_buffer:
             with zipfile.ZipFile(zip_buffer, mode="w") as zip_file:
-                for blob in sorted(
-                    bucket.list_blobs(prefix=f"{connection_id}/{state}"),
-                    key=lambda b: b.time_created,
-                ):
-                    blob_count += 1
+                for entry in entries:
+                    blob = bucket.blob(entry.get("blob"))
                     name = blob.name.split("/")[-1]
                     try:
-                        data = blob.download_as_bytes()
-                        logging.info(f"Downloaded blob: {name}, size: {len(data)}")
-                        zip_file.writestr(name, data)
-                        # XXX: Keeping 100% of previous data for analysis and improvement right now
-                        bucket.rename_blob(blob, "data_collection/" + blob.name)
-                        # TODO: delete 80-90% of previous data after we go live
-                        # blob.delete()
+                        cached = None if transfer.is_original else derivatives.get(blob.name, transfer)
+                        if cached:
+                            data, name = cached
+                        else:
+                            data = blob.download_as_bytes()
+                            logging.info(f"Downloaded blob: {name}, size: {len(data)}")
+                            if not transfer.is_original:
+                                data, name = transfer.apply(data, name)
+                                derivatives.put(blob.name, transfer, data, name)
+                        # the sequence number prefix is what the desktop acknowledges
+                        zip_file.writestr(f"{entry.get('seq'):010d}_{name}", data)
+                        packed.append(entry)
                     except Exception as e:
+                        # stop here so nothing after it is acknowledged and the next poll retries it
                         logging.error(f"Error processing blob {name}: {e}")
+                        break
+
+                logging.info(f"Processed {len(packed)} of {len(entries)} blobs.")
 
-                logging.info(f"Processed {blob_count} blobs.")
+            if packed and auto_ack:
+                acknowledge(connection_id, state, doc_ref, doc, packed[-1].get("seq"))
+            if lease:
+                lease.release()
 
             zip_buffer.seek(0)
 
             logging.info(f"Finished pack_images_zip for {connection_id}/{state}")
-            yield from zip_buffer
+            # fixed size chunks, iterating the buffer itself splits binary data on newlines
+            yield from iter(lambda: zip_buffer.read(ZIP_CHUNK_SIZE), b"")
     except Exception as e:
         logging.error(f"Error building zip file: {e}")
+    finally:
+        if lease:
+            lease.release()
@@ -0,0 +1,111 @@
+# Per-connection image manifest, so the image queue never has to list the bucket.
+#
+# connections/{id}                                  image_seq.{state}: last sequence number handed out
+#                                                   acked_seq.{state}: everything up to here reached the desktop
+#                                                   recent_hashes.{state}: hashes of the last uploads, see dedup.py
+#                                                   upload_bucket: upload rate limit, see ratelimit.py
+# connections/{id}/queues/{state}/images/{seq}      {seq, blob, created_at}
+#
+# Enqueue appends an entry with the next sequence number in a transaction. Dequeue compares the two
+# counters on the connection document (which it has already read) to answer "anything new?" without
+# another read, and otherwise runs one range query on seq, so a poll costs O(new images).
+#
+# Entries stay in the manifest until the desktop acknowledges them, a download that fails partway
+# is simply requested again from the same cursor. Appending and acknowledging both push the
+# connection's expires_at forward (see sweeper.py).
+from typing import Optional
+from google.cloud import firestore
+from dedup import DEDUP_WINDOW, recent_hashes
+from ratelimit import Throttled, take_upload_token, upload_directive
+from sweeper import connection_expiry
+
+IMAGE_STATES = ("calibrating", "organizing")
+
+
+def manifest(doc_ref, state: str):
+    return doc_ref.collection("queues").document(state).collection("images")
+
+
+def last_seq(doc: dict, state: str) -> int:
+    return (doc.get("image_seq") or {}).get(state, 0)
+
+
+def acked_seq(doc: dict, state: str) -> int:
+    return (doc.get("acked_seq") or {}).get(state, 0)
+
+
+def queue_depth(doc: dict, state: str) -> int:
+    """Images enqueued but not acknowledged yet."""
+    return last_seq(doc, state) - acked_seq(doc, state)
+
+
+def append_image(db, doc_ref, state: str, blob_name: str, image_hash: Optional[str] = None) -> int:
+    """Sequence number of the new entry, raises ratelimit.Throttled when the connection is over its limits."""
+    return _append_image(db.transaction(), doc_ref, state, blob_name, image_hash)
+
+
+@firestore.transactional
+def _append_image(transaction, doc_ref, state: str, blob_name: str, image_hash: Optional[str]) -> int:
+    snapshot = doc_ref.get(transaction=transaction)
+    doc = snapshot.to_dict() or {}
+    # enqueue checked a document read before the upload, concurrent uploads may have spent the tokens since
+    turned_away = upload_directive(doc, queue_depth(doc, state))
+    if turned_away:
+        raise Throttled(*turned_away)
+    seq = last_seq(doc, state) + 1
+    # a session that's still uploading isn't abandoned, however long it stays in one state
+    update = {f"image_seq.{state}": seq, "expires_at": connection_expiry(), **take_upload_token(doc)}
+    if image_hash:
+        update[f"recent_hashes.{state}"] = (recent_hashes(doc, state) + [image_hash])[-DEDUP_WINDOW:]
+    transaction.update(doc_ref, update)
+    transaction.set(
+        manifest(doc_ref, state).document(f"{seq:010d}"),
+        {"seq": seq, "blob": blob_name, "hash": image_hash, "created_at": firestore.SERVER_TIMESTAMP},
+    )
+    return seq
+
+
+def pending_images(
+    doc_ref,
+    doc: dict,
+    state: str,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> list:
+    """Manifest entries with since < seq <= until, since defaults to the acknowledged cursor."""
+    since = acked_seq(doc, state) if since is None else since
+    until = last_seq(doc, state) if until is None else min(until, last_seq(doc, state))
+    if until <= since:
+        return []
+
+    query = (
+        manifest(doc_ref, state)
+        .where(filter=firestore.FieldFilter("seq", ">", since))
+        .where(filter=firestore.FieldFilter("seq", "<=", until))
+        .order_by("seq")
+    )
+    if limit:
+        query = query.limit(limit)
+    return list(query.stream())
+
+
+def ack(db, doc_ref, state: str, seq: int) -> int:
+    """Moves the acknowledged cursor forward to seq and returns where it was before."""
+    return _ack(db.transaction(), doc_ref, state, seq)
+
+
+@firestore.transactional
+def _ack(transaction, doc_ref, state: str, seq: int) -> int:
+    # concurrent acks must never move the cursor backwards
+    snapshot = doc_ref.get(transaction=transaction)
+    previous = acked_seq(snapshot.to_dict() or {}, state)
+    update = {"expires_at": connection_expiry()}
+    if seq > previous:
+        update[f"acked_seq.{state}"] = seq
+    transaction.update(doc_ref, update)
+    return previous
+
+
+def all_entries(doc_ref) -> list:
+    return [entry for state in IMAGE_STATES for entry in manifest(doc_ref, state).stream()]
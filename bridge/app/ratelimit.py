@@ -0,0 +1,60 @@
+# Upload backpressure per connection.
+#
+# - a token bucket (UPLOAD_RATE images per second, bursts of UPLOAD_BURST) so one runaway phone
+#   can't take an instance's CPU and storage from every other session
+# - a maximum queue depth (images enqueued but not acknowledged by the desktop yet), a desktop
+#   that fell behind doesn't need more images, it needs time
+# Hitting either isn't an error, enqueue answers with a directive and how long to wait:
+# "slow_down" when the bucket is empty, "pause" when the queue is full.
+#
+# The bucket lives on the connection document (upload_bucket: {tokens, updated_at}) so every
+# instance sees the same one. Enqueue checks it on the document it has already read so a phone
+# over its limits costs no work, then checks again and takes the token in the manifest transaction
+# (manifest.append_image): concurrent uploads that all passed the first check on the same stale
+# document can't spend the same token twice, the ones that lose are turned away there (Throttled)
+# and their blob is deleted again. Uploads dropped before that (duplicates, see dedup.py) don't
+# cost a token.
+import os
+import time
+from typing import Optional
+
+UPLOAD_RATE = float(os.getenv("UPLOAD_RATE", "2"))  # images per second
+UPLOAD_BURST = float(os.getenv("UPLOAD_BURST", "10"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "50"))
+PAUSE_SECONDS = 2.0
+
+if UPLOAD_RATE <= 0:
+    raise ValueError(f"UPLOAD_RATE must be positive, got {UPLOAD_RATE}")
+if UPLOAD_BURST < 1:
+    raise ValueError(f"UPLOAD_BURST must be at least 1, got {UPLOAD_BURST}")
+
+
+class Throttled(Exception):
+    def __init__(self, directive: str, retry_after: float):
+        super().__init__(f"{directive}, retry after {retry_after:.2f}s")
+        self.directive = directive
+        self.retry_after = retry_after
+
+
+def upload_tokens(doc: dict, now: float) -> float:
+    bucket = doc.get("upload_bucket") or {}
+    tokens = bucket.get("tokens", UPLOAD_BURST)
+    elapsed = max(0.0, now - bucket.get("updated_at", now))
+    return min(UPLOAD_BURST, tokens + elapsed * UPLOAD_RATE)
+
+
+def take_upload_token(doc: dict, now: Optional[float] = None) -> dict:
+    """The connection document update spending one token."""
+    now = time.time() if now is None else now
+    return {"upload_bucket": {"tokens": upload_tokens(doc, now) - 1, "updated_at": now}}
+
+
+def upload_directive(doc: dict, queue_depth: int, now: Optional[float] = None) -> Optional[tuple[str, float]]:
+    """(directive, seconds to wait) when an upload has to be turned away, None when it can go ahead."""
+    now = time.time() if now is None else now
+    if queue_depth >= MAX_QUEUE_DEPTH:
+        return "pause", PAUSE_SECONDS
+    tokens = upload_tokens(doc, now)
+    if tokens < 1:
+        return "slow_down", (1 - tokens) / UPLOAD_RATE
+    return None
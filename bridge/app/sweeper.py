@@ -0,0 +1,108 @@
+# Expiry of abandoned connections.
+#
+# Every connection document carries an `expires_at` timestamp that is pushed forward whenever the
+# connection changes state and whenever an image is enqueued or acknowledged (manifest.py), so a
+# session that stays in calibrating or organizing for longer than CONNECTION_TTL while it's still
+# moving images isn't swept out from under it. A desktop that crashes before end_connection leaves
+# its document and blobs behind, POST /sweep_expired_connections (run from Cloud Scheduler) finds
+# those with a range query on the single-field `expires_at` index, deletes the documents in
+# batched writes and hands the blobs to the archiver.
+#
+# Documents created before expires_at existed don't have the field, and a range query never
+# matches a missing field, so the sweeper never sees them. Backfill them once (set expires_at to
+# their last activity plus CONNECTION_TTL) if they should be cleaned up too.
+#
+# The same run deletes the expired lease documents of the firestore events backend (events.py),
+# released leases are deleted by their holder but a crashed one leaves its document behind. Each
+# is re-read in a transaction before it's deleted, someone may have taken it since the query.
+#
+# A Firestore TTL policy on connections.expires_at can be enabled as a backstop for the documents,
+# it does not clean up the blobs though, so the sweeper is still needed.
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from google.cloud import firestore
+from pydantic import BaseModel
+from events import LEASE_COLLECTION
+
+CONNECTION_TTL = timedelta(seconds=int(os.getenv("CONNECTION_TTL_SECONDS", str(60 * 60))))
+SWEEP_BATCH_SIZE = 500  # max writes in one Firestore batch
+
+
+def connection_expiry(now: Optional[datetime] = None) -> datetime:
+    return (now or datetime.now(timezone.utc)) + CONNECTION_TTL
+
+
+class SweepStats(BaseModel):
+    expired: int = 0
+    batches: int = 0
+    more: bool = False  # hit max_connections, run again
+    oldest_expired_at: Optional[datetime] = None
+    leases_expired: int = 0
+    duration_ms: float = 0.0
+
+
+def sweep_expired_connections(db, archiver, max_connections: int = 5000) -> SweepStats:
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc)
+    stats = SweepStats()
+
+    while stats.expired < max_connections:
+        limit = min(SWEEP_BATCH_SIZE, max_connections - stats.expired)
+        docs = list(
+            db.collection("connections")
+            .where(filter=firestore.FieldFilter("expires_at", "<", now))
+            .order_by("expires_at")
+            .limit(limit)
+            .stream()
+        )
+        if not docs:
+            break
+
+        batch = db.batch()
+        for doc in docs:
+            batch.delete(doc.reference)
+        batch.commit()
+        stats.batches += 1
+
+        for doc in docs:
+            data = doc.to_dict()
+            if stats.oldest_expired_at is None:
+                stats.oldest_expired_at = data.get("expires_at")
+            archiver.archive_connection(doc.id, data)
+        stats.expired += len(docs)
+
+        if len(docs) < limit:
+            break
+    else:
+        stats.more = True
+
+    stats.leases_expired = sweep_expired_leases(db, now, max_connections)
+    stats.duration_ms = (time.perf_counter() - started) * 1000
+    logging.info(f"Swept expired connections: {stats.model_dump_json()}")
+    return stats
+
+
+def sweep_expired_leases(db, now: datetime, max_leases: int) -> int:
+    expired = (
+        db.collection(LEASE_COLLECTION)
+        .where(filter=firestore.FieldFilter("expires_at", "<", now))
+        .order_by("expires_at")
+        .limit(max_leases)
+        .stream()
+    )
+    deleted = 0
+    for lease in expired:
+        deleted += _delete_expired_lease(db.transaction(), lease.reference, now)
+    return deleted
+
+
+@firestore.transactional
+def _delete_expired_lease(transaction, lease_ref, now: datetime) -> bool:
+    lease = lease_ref.get(transaction=transaction)
+    if not lease.exists or lease.to_dict().get("expires_at") >= now:
+        return False
+    transaction.delete(lease_ref)
+    return True
@@ -0,0 +1,170 @@
+# Image transfer formats for the desktop's image queue downloads.
+#
+# Uploads are stored as the phone sent them. The desktop picks what it downloads with query
+# parameters on GET /image_queue (format, quality, grayscale, max_edge) or, without a format
+# parameter, with image types in its Accept header next to application/zip
+# ("application/zip, image/webp;q=0.9, image/jpeg;q=0.5"). The ZIP itself stays ZIP_STORED, JPEGs
+# don't compress any further so the savings have to come from the images.
+#
+# Derivatives are made with Pillow: JPEGs are decoded at a reduced DCT scale (draft) when max_edge
+# allows it, EXIF orientation is applied since the metadata isn't carried over, and a derivative
+# that ends up larger than the original is replaced by the original. Uploads Pillow can't decode
+# are sent as uploaded too, only download errors stop a ZIP early. Derivatives are kept in a
+# per-instance LRU cache bounded in bytes, so ranges that are fetched again after a failed download
+# and non-acknowledging readers don't transcode the same image twice.
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
+from typing import Optional
+
+# format => (Pillow format, file extension, media type)
+FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "avif": ("AVIF", "avif", "image/avif"),
+}
+# fastest encoder effort, at the default WebP takes ~3x and AVIF ~1.5x as long for a few % smaller files
+ENCODER_OPTIONS = {
+    "webp": {"method": 0},
+    "avif": {"speed": 8},
+}
+DEFAULT_QUALITY = 85
+DERIVATIVE_CACHE_BYTES = int(float(os.getenv("DERIVATIVE_CACHE_MB", "256")) * 2**20)
+
+
+@lru_cache(maxsize=None)
+def available_formats() -> tuple[str, ...]:
+    from PIL import Image
+
+    Image.init()
+    return ("original",) + tuple(name for name, (pil_format, _, _) in FORMATS.items() if pil_format in Image.SAVE)
+
+
+@dataclass(frozen=True)
+class Transfer:
+    format: str = "original"
+    quality: Optional[int] = None
+    grayscale: bool = False
+    max_edge: Optional[int] = None
+
+    @property
+    def is_original(self) -> bool:
+        return self.format == "original"
+
+    @property
+    def key(self) -> str:
+        """Short name of the transfer, also sent back in the X-Image-Transfer header."""
+        if self.is_original:
+            return "original"
+        parts = [self.format, f"q{self.quality or DEFAULT_QUALITY}"]
+        if self.grayscale:
+            parts.append("gray")
+        if self.max_edge:
+            parts.append(f"e{self.max_edge}")
+        return "-".join(parts)
+
+    def apply(self, data: bytes, name: str) -> tuple[bytes, str]:
+        """The image bytes to send and their file name, the original when it can't be re-encoded."""
+        if self.is_original:
+            return data, name
+        from PIL import Image, ImageOps, UnidentifiedImageError
+
+        pil_format, extension, _ = FORMATS[self.format]
+        try:
+            with Image.open(BytesIO(data)) as image:
+                scale = self.max_edge / max(image.size) if self.max_edge else 1.0
+                if scale < 1:
+                    # JPEG only, decodes at 1/2, 1/4 or 1/8 scale as long as it stays at least this large
+                    size = (math.ceil(image.width * scale), math.ceil(image.height * scale))
+                    image.draft("L" if self.grayscale else "RGB", size)
+                image = ImageOps.exif_transpose(image)
+                image = image.convert("L" if self.grayscale else "RGB")
+                if self.max_edge:
+                    image.thumbnail((self.max_edge, self.max_edge), Image.Resampling.BILINEAR, reducing_gap=2.0)
+                with BytesIO() as out:
+                    image.save(
+                        out, pil_format, quality=self.quality or DEFAULT_QUALITY, **ENCODER_OPTIONS.get(self.format, {})
+                    )
+                    derivative = out.getvalue()
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+            # fails the same way on every attempt, an error here would stall the queue on this image
+            logging.warning(f"Sending {name} as uploaded, can't re-encode it: {e}")
+            return data, name
+
+        if len(derivative) >= len(data):
+            return data, name
+        return derivative, f"{name.rsplit('.', 1)[0]}.{extension}"
+
+
+def negotiate(
+    format: Optional[str],
+    quality: Optional[int],
+    grayscale: bool,
+    max_edge: Optional[int],
+    accept: Optional[str],
+) -> Transfer:
+    """The transfer asked for, raises ValueError for formats this instance can't encode."""
+    available = available_formats()
+    if format is None:
+        format = _accepted_format(accept, available)
+        if format == "original" and (quality or grayscale or max_edge):
+            # transforming the image means re-encoding it anyway
+            format = "jpeg"
+    elif format not in available:
+        raise ValueError(f"Unsupported image format {format}, available: {', '.join(available)}")
+    elif format == "original" and (quality or grayscale or max_edge):
+        raise ValueError("The original image can't be re-encoded, pick a format")
+    return Transfer(format, quality, grayscale, max_edge)
+
+
+def _accepted_format(accept: Optional[str], available: tuple[str, ...]) -> str:
+    media_types = {FORMATS[name][2]: name for name in available if name in FORMATS}
+    best, best_q = "original", 0.0
+    for item in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        if media_type not in media_types:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    pass
+        if q > best_q:
+            best, best_q = media_types[media_type], q
+    return best
+
+
+class DerivativeCache:
+    def __init__(self, max_bytes: int = DERIVATIVE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: OrderedDict[tuple[str, str], tuple[bytes, str]] = OrderedDict()
+        # filled from the threads StreamingResponse iterates the ZIP generators on
+        self._lock = threading.Lock()
+
+    def get(self, blob_name: str, transfer: Transfer) -> Optional[tuple[bytes, str]]:
+        with self._lock:
+            item = self._items.get((blob_name, transfer.key))
+            if item is not None:
+                self._items.move_to_end((blob_name, transfer.key))
+            return item
+
+    def put(self, blob_name: str, transfer: Transfer, data: bytes, name: str) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop((blob_name, transfer.key), None)
+            if previous is not None:
+                self.size -= len(previous[0])
+            self._items[(blob_name, transfer.key)] = (data, name)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
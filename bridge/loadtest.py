@@ -0,0 +1,342 @@
+# Load generator for the bridge: simulated desktop + mobile clients driving whole sessions
+# create -> join -> calibrating uploads/dequeues -> organizing uploads/dequeues -> end
+# against the FastAPI app in this process, with Firestore and Cloud Storage kept in memory (memstore.py).
+#
+# Reports session throughput, latency percentiles per endpoint, memory per session and event-loop
+# lag. The app shares the event loop with the simulated clients, so blocking calls in async
+# endpoints show up directly as loop lag. Use it to size Cloud Run --concurrency (sessions a
+# single instance handles before latency or lag climbs) and to catch regressions in the ZIP and
+# queue paths by comparing --json reports between commits.
+#
+# Usage: python3 ./bridge/loadtest.py [--sessions 1000] [--concurrency 50] [--json report.json]
+# Needs httpx on top of requirements.txt, Pillow is used for realistic JPEGs when installed.
+# --emulator skips the in-memory store, start the Firestore and GCS emulators and set
+# FIRESTORE_EMULATOR_HOST / STORAGE_EMULATOR_HOST first.
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import sys
+import time
+import zipfile
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import parse_qsl
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+LAG_INTERVAL = 0.01  # s between event-loop lag probes
+PERCENTILES = (50, 90, 99)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.loop_lag: list[float] = []
+        self.sessions_ok = 0
+        self.sessions_failed = 0
+        self.images_sent = 0
+        self.images_dropped = 0
+        self.images_throttled = 0
+        self.images_received = 0
+        self.zip_bytes = 0
+        self.rss_baseline = rss_bytes()
+        self.rss_peak = self.rss_baseline
+
+    async def call(self, name: str, request, expected: tuple[int, ...] = (200, 204)):
+        start = time.perf_counter()
+        try:
+            response = await request
+        except Exception:
+            self.errors[name] += 1
+            raise
+        self.latencies[name].append(time.perf_counter() - start)
+        if response.status_code not in expected:
+            self.errors[name] += 1
+            raise RuntimeError(f"{name} returned {response.status_code}: {response.text[:200]}")
+        return response
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak instead of current outside Linux, kilobytes there (bytes on macOS)
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def make_images(count: int, size_kb: int) -> list[bytes]:
+    try:
+        from PIL import Image
+    except ImportError:
+        # the bridge only looks inside the images with --transfer, random bytes load it the same way otherwise
+        return [random.randbytes(size_kb * 1024) for _ in range(count)]
+
+    images = []
+    side = max(16, int((size_kb * 1024 * 2) ** 0.5))
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.effect_noise((side, side), random.uniform(32, 96)).save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+async def monitor(stats: Stats, stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        stats.loop_lag.append(max(0.0, loop.time() - start - LAG_INTERVAL))
+        stats.rss_peak = max(stats.rss_peak, rss_bytes())
+
+
+async def upload(
+    client, stats: Stats, connection_id: str, state: str, images: list[bytes], args: argparse.Namespace
+) -> None:
+    for image in images:
+        # a phone held still sends the same frame again, the bridge drops it and says move
+        repeats = 1 + (random.random() < args.duplicate_rate)
+        while repeats:
+            response = await stats.call(
+                "POST /image_queue",
+                client.post(
+                    f"/image_queue/{connection_id}",
+                    params={"state": state},
+                    files={"image_file": ("image.jpg", image, "image/jpeg")},
+                ),
+            )
+            stats.images_sent += 1
+            body = response.json()
+            directive = body.get("directive")
+            if directive in ("slow_down", "pause"):
+                # over the connection's rate limit or queue depth, the same frame goes again later
+                stats.images_throttled += 1
+                await asyncio.sleep(body.get("retry_after", 1))
+                continue
+            repeats -= 1
+            if directive == "move":
+                stats.images_dropped += 1
+            elif directive != "more_images":
+                return
+
+
+async def receive(
+    client, stats: Stats, connection_id: str, state: str, count: int, args: argparse.Namespace
+) -> None:
+    received, cursor = 0, 0
+    deadline = time.monotonic() + args.timeout
+    while received < count:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Received {received} of {count} {state} images for {connection_id}")
+
+        params = {"state": state, "wait": args.wait, **dict(parse_qsl(args.transfer))}
+        if args.dequeue == "cursor":
+            params["since"] = cursor
+        response = await stats.call(
+            "GET /image_queue", client.get(f"/image_queue/{connection_id}", params=params)
+        )
+        if response.status_code == 204:
+            continue
+
+        names = zipfile.ZipFile(io.BytesIO(response.content)).namelist()
+        received += len(names)
+        stats.images_received += len(names)
+        stats.zip_bytes += len(response.content)
+        if args.dequeue == "cursor":
+            cursor = max(int(name.split("_", 1)[0]) for name in names)
+            await stats.call(
+                "POST /image_queue/ack",
+                client.post(f"/image_queue/{connection_id}/ack", params={"state": state, "seq": cursor}),
+            )
+
+
+async def run_session(client, stats: Stats, images: list[bytes], args: argparse.Namespace) -> None:
+    response = await stats.call("POST /create_connection", client.post("/create_connection"))
+    connection_id = response.json()["connection_id"]
+
+    # the desktop long-polls for the phone while the phone scans the QR code
+    connected = asyncio.create_task(
+        stats.call(
+            "GET /connected_mobile_device_id",
+            client.get(f"/connected_mobile_device_id/{connection_id}", params={"wait": args.wait}),
+        )
+    )
+    await asyncio.sleep(random.uniform(0, args.think_time))
+    await stats.call("POST /join_connection", client.post(f"/join_connection/{connection_id}"))
+    await connected
+
+    for state, count in (("calibrating", args.calibration_images), ("organizing", args.organization_images)):
+        await stats.call(
+            "POST /connection_state",
+            client.post(f"/connection_state/{connection_id}", params={"state": state}),
+        )
+        await asyncio.gather(
+            # distinct frames, the same pool image twice in a state would be dropped as a duplicate
+            upload(client, stats, connection_id, state, random.sample(images, k=count), args),
+            receive(client, stats, connection_id, state, count, args),
+        )
+
+    # the desktop marks the session done, the phone's end deletes and archives it
+    for _ in range(2):
+        await stats.call("POST /end_connection", client.post(f"/end_connection/{connection_id}"))
+
+
+async def run(args: argparse.Namespace, app) -> tuple[Stats, float]:
+    import httpx
+
+    stats = Stats()
+    images = make_images(args.image_pool, args.image_kb)
+    remaining = iter(range(args.sessions))
+
+    async def worker(client) -> None:
+        for _ in remaining:
+            try:
+                await run_session(client, stats, images, args)
+                stats.sessions_ok += 1
+            except Exception as e:
+                stats.sessions_failed += 1
+                if args.verbose:
+                    print(f"Session failed: {e!r}", file=sys.stderr)
+
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(stats, stop))
+    transport = httpx.ASGITransport(app=app)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bridge", limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor_task
+    return stats, elapsed
+
+
+def report(stats: Stats, elapsed: float, args: argparse.Namespace, store_bytes: Optional[int]) -> dict:
+    sessions = stats.sessions_ok + stats.sessions_failed
+    requests = sum(map(len, stats.latencies.values()))
+    rss_end = rss_bytes()
+    lag = sorted(stats.loop_lag)
+
+    result = {
+        "sessions": sessions,
+        "sessions_failed": stats.sessions_failed,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "sessions_per_s": sessions / elapsed,
+        "requests_per_s": requests / elapsed,
+        "images_per_s": stats.images_received / elapsed,
+        "images_sent": stats.images_sent,
+        "images_dropped": stats.images_dropped,
+        "images_throttled": stats.images_throttled,
+        "images_received": stats.images_received,
+        "zip_mb": stats.zip_bytes / 2**20,
+        # retained after all sessions ended (leaks), and peak while `concurrency` sessions were live
+        "retained_kb_per_session": (rss_end - stats.rss_baseline) / 1024 / max(1, sessions),
+        "peak_kb_per_live_session": (stats.rss_peak - stats.rss_baseline) / 1024 / args.concurrency,
+        "store_kb_after_run": None if store_bytes is None else store_bytes / 1024,
+        "loop_lag_ms": {f"p{p}": percentile(lag, p) * 1000 for p in PERCENTILES} | {"max": lag[-1] * 1000 if lag else 0},
+        "endpoints": {},
+    }
+    for name, latencies in sorted(stats.latencies.items()):
+        latencies = sorted(latencies)
+        result["endpoints"][name] = {
+            "count": len(latencies),
+            "errors": stats.errors.get(name, 0),
+            **{f"p{p}_ms": percentile(latencies, p) * 1000 for p in PERCENTILES},
+            "max_ms": latencies[-1] * 1000,
+        }
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(
+        f"{result['sessions']} sessions ({result['sessions_failed']} failed) at concurrency "
+        f"{result['concurrency']} in {result['elapsed_s']:.1f}s"
+    )
+    print(
+        f"throughput: {result['sessions_per_s']:.1f} sessions/s, {result['requests_per_s']:.0f} requests/s, "
+        f"{result['images_per_s']:.0f} images/s ({result['zip_mb']:.1f} MB zipped, "
+        f"{result['images_dropped']} of {result['images_sent']} uploads dropped as duplicates, "
+        f"{result['images_throttled']} throttled)"
+    )
+    print(
+        f"memory: {result['peak_kb_per_live_session']:.0f} KB peak per live session, "
+        f"{result['retained_kb_per_session']:.1f} KB retained per session"
+        + (f", {result['store_kb_after_run']:.0f} KB left in the store" if result["store_kb_after_run"] is not None else "")
+    )
+    lag = result["loop_lag_ms"]
+    print("event loop lag: " + ", ".join(f"{k} {v:.1f} ms" for k, v in lag.items()))
+    print()
+    print(f"{'endpoint':<34} {'count':>7} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, endpoint in result["endpoints"].items():
+        print(
+            f"{name:<34} {endpoint['count']:>7} {endpoint['errors']:>7} {endpoint['p50_ms']:>8.1f} "
+            f"{endpoint['p90_ms']:>8.1f} {endpoint['p99_ms']:>8.1f} {endpoint['max_ms']:>8.1f}"
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Display Organizer bridge load test")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50, help="sessions in flight at once")
+    parser.add_argument("--calibration-images", type=int, default=3)
+    parser.add_argument("--organization-images", type=int, default=2)
+    parser.add_argument("--image-kb", type=int, default=200)
+    parser.add_argument("--image-pool", type=int, default=32, help="distinct images to pick uploads from")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="chance the phone sends a frame twice")
+    parser.add_argument("--dequeue", choices=("auto", "cursor"), default="cursor",
+                        help="auto: acknowledged as sent (legacy desktop), cursor: since + ack (ImageQueue)")
+    parser.add_argument("--wait", type=float, default=5, help="long-poll wait of the desktop requests")
+    parser.add_argument("--transfer", default="", help="image format query of the desktop requests, e.g. format=webp&quality=70")
+    parser.add_argument("--think-time", type=float, default=0.05, help="max delay before the phone joins")
+    parser.add_argument("--timeout", type=float, default=60, help="max seconds to receive one state's images")
+    parser.add_argument("--events-backend", default="local", help="EVENTS_BACKEND for the app")
+    parser.add_argument("--sample-rate", default="0", help="ARCHIVE_SAMPLE_RATE for the app")
+    parser.add_argument("--emulator", action="store_true", help="use the Firestore/GCS emulators instead of memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if max(args.calibration_images, args.organization_images) > args.image_pool:
+        parser.error("--image-pool must be at least the images sent per state")
+
+    random.seed(args.seed)
+    # read by the app's modules at import time
+    os.environ.setdefault("EVENTS_BACKEND", args.events_backend)
+    os.environ.setdefault("ARCHIVE_SAMPLE_RATE", args.sample_rate)
+    sys.path.insert(0, APP_DIR)
+
+    store = None
+    if not args.emulator:
+        import memstore
+
+        store = memstore.install()
+
+    import main as bridge
+
+    stats, elapsed = asyncio.run(run(args, bridge.app))
+    # archive jobs still running count towards what's left in the store
+    bridge.archiver.shutdown(wait=True)
+    bridge.events.close()
+
+    result = report(stats, elapsed, args, store.blob_bytes() if store else None)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 1 if stats.sessions_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,294 @@
+# In-memory stand-ins for the parts of the Firestore and Cloud Storage clients the bridge uses,
+# for running the app without GCP credentials (see loadtest.py).
+#
+# install() has to run before the app is imported: main.py creates its clients at import time and
+# manifest.py applies firestore.transactional when it's loaded. Transactions simply hold the store
+# lock, which is stricter than Firestore's optimistic transactions but behaves the same for callers.
+#
+# To run against the real client libraries instead, start the Firestore and GCS emulators and set
+# FIRESTORE_EMULATOR_HOST / STORAGE_EMULATOR_HOST, both clients pick those up on their own.
+import contextlib
+import copy
+import operator
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.documents: dict[str, dict] = {}
+        self.collections: dict[str, set[str]] = {}  # collection path => document paths, for queries
+        self.blobs: dict[str, bytes] = {}
+        self.listeners: dict[str, list[Callable]] = {}
+
+    def blob_bytes(self) -> int:
+        with self.lock:
+            return sum(map(len, self.blobs.values()))
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: "DocumentReference", data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str):
+        value = self._data
+        for key in field_path.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+
+class Watch:
+    def __init__(self, store: Store, path: str, callback: Callable):
+        self._store = store
+        self._path = path
+        self._callback = callback
+
+    def unsubscribe(self) -> None:
+        with self._store.lock:
+            listeners = self._store.listeners.get(self._path, [])
+            if self._callback in listeners:
+                listeners.remove(self._callback)
+
+
+class DocumentReference:
+    def __init__(self, store: Store, path: str):
+        self._store = store
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._store, f"{self.path}/{name}")
+
+    def get(self, transaction=None) -> DocumentSnapshot:
+        with self._store.lock:
+            return DocumentSnapshot(self, copy.deepcopy(self._store.documents.get(self.path)))
+
+    def set(self, data: dict) -> None:
+        with self._store.lock:
+            self._store.documents[self.path] = copy.deepcopy(_resolve(data))
+            self._store.collections.setdefault(self.path.rsplit("/", 1)[0], set()).add(self.path)
+        self._changed()
+
+    def update(self, data: dict) -> None:
+        with self._store.lock:
+            if self.path not in self._store.documents:
+                raise KeyError(f"No document to update: {self.path}")
+            document = self._store.documents[self.path]
+            for field_path, value in data.items():
+                *parents, key = field_path.split(".")
+                target = document
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[key] = copy.deepcopy(_resolve(value))
+        self._changed()
+
+    def delete(self) -> None:
+        with self._store.lock:
+            self._store.documents.pop(self.path, None)
+            self._store.collections.get(self.path.rsplit("/", 1)[0], set()).discard(self.path)
+        self._changed()
+
+    def on_snapshot(self, callback: Callable) -> Watch:
+        with self._store.lock:
+            self._store.listeners.setdefault(self.path, []).append(callback)
+        return Watch(self._store, self.path, callback)
+
+    def _changed(self) -> None:
+        with self._store.lock:
+            listeners = list(self._store.listeners.get(self.path, ()))
+        if listeners:
+            snapshot = self.get()
+            for callback in listeners:
+                callback([snapshot], [], None)
+
+
+class Query:
+    def __init__(self, collection: "CollectionReference", filters=(), order_by=None, limit=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._order_by = order_by
+        self._limit = limit
+
+    def where(self, filter) -> "Query":
+        return Query(self._collection, self._filters + [filter], self._order_by, self._limit)
+
+    def order_by(self, field_path: str) -> "Query":
+        return Query(self._collection, self._filters, field_path, self._limit)
+
+    def limit(self, count: int) -> "Query":
+        return Query(self._collection, self._filters, self._order_by, count)
+
+    def stream(self) -> Iterator[DocumentSnapshot]:
+        store = self._collection._store
+        with store.lock:
+            documents = [
+                (path, copy.deepcopy(store.documents[path]))
+                for path in store.collections.get(self._collection.path, ())
+            ]
+
+        matches = [
+            DocumentSnapshot(DocumentReference(store, path), data)
+            for path, data in documents
+            if all(
+                f.field_path in data and OPERATORS[f.op_string](data[f.field_path], f.value)
+                for f in self._filters
+            )
+        ]
+        if self._order_by:
+            matches.sort(key=lambda snapshot: snapshot.get(self._order_by))
+        return iter(matches[: self._limit] if self._limit else matches)
+
+
+class CollectionReference(Query):
+    def __init__(self, store: Store, path: str):
+        self._store = store
+        self.path = path
+        super().__init__(self)
+
+    def document(self, document_id: str) -> DocumentReference:
+        return DocumentReference(self._store, f"{self.path}/{document_id}")
+
+
+class WriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference: DocumentReference, data: dict) -> None:
+        self._writes.append(lambda: reference.set(data))
+
+    def delete(self, reference: DocumentReference) -> None:
+        self._writes.append(reference.delete)
+
+    def commit(self) -> None:
+        for write in self._writes:
+            write()
+
+
+class Transaction:
+    def __init__(self, store: Store):
+        self._store = store
+
+    def set(self, reference: DocumentReference, data: dict) -> None:
+        reference.set(data)
+
+    def update(self, reference: DocumentReference, data: dict) -> None:
+        reference.update(data)
+
+    def delete(self, reference: DocumentReference) -> None:
+        reference.delete()
+
+
+class FirestoreClient:
+    def __init__(self, store: Store):
+        self._store = store
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self._store, name)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch()
+
+    def transaction(self) -> Transaction:
+        return Transaction(self._store)
+
+
+def transactional(function: Callable) -> Callable:
+    def run(transaction: Transaction, *args, **kwargs):
+        with transaction._store.lock:
+            return function(transaction, *args, **kwargs)
+
+    return run
+
+
+class Blob:
+    def __init__(self, bucket: "Bucket", name: str):
+        self._bucket = bucket
+        self.name = name
+
+    @property
+    def size(self) -> Optional[int]:
+        data = self._bucket._store.blobs.get(self.name)
+        return None if data is None else len(data)
+
+    def upload_from_string(self, data, content_type: Optional[str] = None) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        with self._bucket._store.lock:
+            self._bucket._store.blobs[self.name] = bytes(data)
+
+    def download_as_bytes(self) -> bytes:
+        with self._bucket._store.lock:
+            if self.name not in self._bucket._store.blobs:
+                raise FileNotFoundError(self.name)
+            return self._bucket._store.blobs[self.name]
+
+    def exists(self) -> bool:
+        return self.name in self._bucket._store.blobs
+
+    def delete(self) -> None:
+        with self._bucket._store.lock:
+            if self._bucket._store.blobs.pop(self.name, None) is None:
+                raise FileNotFoundError(self.name)
+
+
+class Bucket:
+    def __init__(self, store: Store, name: str):
+        self._store = store
+        self.name = name
+
+    def blob(self, name: str) -> Blob:
+        return Blob(self, name)
+
+    def list_blobs(self, prefix: str = "", max_results: Optional[int] = None) -> Iterator[Blob]:
+        with self._store.lock:
+            names = sorted(name for name in self._store.blobs if name.startswith(prefix))
+        return iter([Blob(self, name) for name in names[:max_results]])
+
+
+class StorageClient:
+    def __init__(self, store: Store):
+        self._store = store
+
+    def bucket(self, name: str) -> Bucket:
+        return Bucket(self._store, name)
+
+    def batch(self, raise_exception: bool = True):
+        return contextlib.nullcontext()
+
+
+def _resolve(value):
+    from google.cloud import firestore
+
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _resolve(v) for key, v in value.items()}
+    return value
+
+
+def install(store: Optional[Store] = None) -> Store:
+    """Points google.cloud.firestore / storage at one in-memory store, call before importing main."""
+    from google.cloud import firestore, storage
+
+    store = store or Store()
+    firestore.Client = lambda *args, **kwargs: FirestoreClient(store)
+    firestore.transactional = transactional
+    storage.Client = lambda *args, **kwargs: StorageClient(store)
+    return store
@@ -1,15 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 import zipfile
-import cv2
-import numpy as np
 import requests
 import os
+from urllib.parse import parse_qsl
 from pydantic import BaseModel
 
+# cv2/numpy are only needed to decode images, keep them out of startup for the terminal pairing path
+if TYPE_CHECKING:
+    import numpy as np
+
 BASE_URL = os.getenv("API_BASE_URL")
 AUTH_TOKEN = os.getenv("AUTH_TOKEN")
 HEADERS = {"Accept": "application/json", "Authorization": f"bearer {AUTH_TOKEN}"}
+LONG_POLL_WAIT = 20  # seconds the bridge may hold a request open until something changes
+# image format the bridge sends, query parameters of GET /image_queue (e.g. "format=webp&quality=80"
+# on slow links), the originals by default, see the bridge's transfer.py
+IMAGE_TRANSFER = dict(parse_qsl(os.getenv("IMAGE_TRANSFER", "")))
 
 
 def create_connection() -> str:
@@ -26,9 +34,12 @@ class ConnectedMobileDevice(BaseModel):
     device_id: Optional[str]
 
 
-def get_connected_mobile_device_id(connection_id: str) -> ConnectedMobileDevice:
+def get_connected_mobile_device_id(connection_id: str, wait: float = 0) -> ConnectedMobileDevice:
     response = requests.request(
-        "GET", f"{BASE_URL}/connected_mobile_device_id/{connection_id}", headers=HEADERS
+        "GET",
+        f"{BASE_URL}/connected_mobile_device_id/{connection_id}",
+        params={"wait": wait} if wait else None,
+        headers=HEADERS,
     )
     response.raise_for_status()
     print(response.text)
@@ -55,14 +66,14 @@ def end_connection(connection_id: str):
     print(response.status_code)
 
 
-def get_images(connection_id: str, state: str) -> list[np.ndarray]:
+def get_image_bytes(connection_id: str, state: str) -> list[tuple[str, bytes]]:
     headers = HEADERS.copy()
-    headers.update(
-        {"Accept-Encoding": "gzip, deflate, br", "Accept": "application/zip"}
-    )
+    # the ZIP holds already compressed images, content encoding would only cost CPU on both ends
+    headers.update({"Accept-Encoding": "identity", "Accept": "application/zip"})
     response = requests.request(
         "GET",
-        f"{BASE_URL}/image_queue/{connection_id}?state={state}",
+        f"{BASE_URL}/image_queue/{connection_id}",
+        params={"state": state, **IMAGE_TRANSFER},
         headers=headers,
         stream=True,
     )
@@ -75,13 +86,149 @@ def get_images(connection_id: str, state: str) -> list[np.ndarray]:
     with zipfile.ZipFile(BytesIO(response.content)) as zip:
         for fname in zip.namelist():
             with zip.open(fname) as img_file:
-                img_bytes = img_file.read()
-                img_np = np.frombuffer(img_bytes, dtype=np.uint8)
-                img_cv2 = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
+                images.append((fname, img_file.read()))
+
+    return images
+
+
+IMAGE_RANGE_SIZE = 8  # images per request when fetching the queue in ranges
+IMAGE_RANGE_WORKERS = 4
+IMAGE_RANGE_RETRIES = 2
+
+
+def get_image_range(
+    connection_id: str,
+    state: str,
+    since: int,
+    until: Optional[int] = None,
+    limit: Optional[int] = None,
+    wait: float = 0,
+) -> tuple[int, list[tuple[int, str, bytes]]]:
+    """Returns the queue head and the (seq, name, bytes) of the images with since < seq <= until."""
+    headers = HEADERS.copy()
+    headers.update({"Accept-Encoding": "identity", "Accept": "application/zip"})
+    params = {"state": state, "since": since, **IMAGE_TRANSFER}
+    if until is not None:
+        params["until"] = until
+    if limit is not None:
+        params["limit"] = limit
+    if wait:
+        params["wait"] = wait
+
+    response = requests.request(
+        "GET",
+        f"{BASE_URL}/image_queue/{connection_id}",
+        params=params,
+        headers=headers,
+    )
+    response.raise_for_status()
+    head = int(response.headers.get("X-Queue-Head", since))
+
+    if response.status_code == 204:
+        return head, []
+
+    images = []
+    with zipfile.ZipFile(BytesIO(response.content)) as zip:
+        for fname in zip.namelist():
+            with zip.open(fname) as img_file:
+                images.append((image_seq(fname), fname, img_file.read()))
 
-                if img_cv2 is None:
-                    raise Exception(f"Could not decode {fname} into a OpenCV image")
+    return head, images
 
-                images.append(img_cv2)
+
+def image_seq(name: str) -> int:
+    """Sequence number of an image queue file, the bridge prefixes it to the name."""
+    return int(name.split("_", 1)[0])
+
+
+def ack_images(connection_id: str, state: str, seq: int):
+    response = requests.request(
+        "POST",
+        f"{BASE_URL}/image_queue/{connection_id}/ack",
+        params={"state": state, "seq": seq},
+        headers=HEADERS,
+    )
+    response.raise_for_status()
+
+
+def scene_changed(connection_id: str, state: str):
+    """Tells the bridge the screens were redrawn, so photos of the new scene aren't dropped as duplicates."""
+    response = requests.request(
+        "POST",
+        f"{BASE_URL}/image_queue/{connection_id}/scene",
+        params={"state": state},
+        headers=HEADERS,
+    )
+    response.raise_for_status()
+
+
+class ImageQueue:
+    """Resumable reader for one state's image queue.
+
+    Images are only acknowledged once they arrived, a failed download is fetched again from the
+    cursor on the next call. When more images are waiting than fit in one request the rest of
+    the queue is fetched as ranges in parallel and only ranges that failed are retried.
+    """
+
+    def __init__(self, connection_id: str, state: str, wait: float = LONG_POLL_WAIT):
+        self.connection_id = connection_id
+        self.state = state
+        self.wait = wait
+        self.cursor = 0
+        self._executor = ThreadPoolExecutor(max_workers=IMAGE_RANGE_WORKERS)
+
+    def fetch(self) -> list[tuple[str, bytes]]:
+        # long-polls, returns as soon as the phone uploads something
+        head, images = get_image_range(
+            self.connection_id, self.state, self.cursor, limit=IMAGE_RANGE_SIZE, wait=self.wait
+        )
+        if not images:
+            return []
+
+        last = images[-1][0]
+        ranges = [
+            (since, min(since + IMAGE_RANGE_SIZE, head))
+            for since in range(last, head, IMAGE_RANGE_SIZE)
+        ]
+        for range_images in self._executor.map(lambda r: self._fetch_range(*r), ranges):
+            images.extend(range_images)
+
+        # only acknowledge up to the first gap, everything after it is fetched again next time
+        received = []
+        for seq, name, data in sorted(images):
+            if seq != self.cursor + len(received) + 1:
+                break
+            received.append((name, data))
+
+        if received:
+            self.cursor += len(received)
+            ack_images(self.connection_id, self.state, self.cursor)
+
+        return received
+
+    def _fetch_range(self, since: int, until: int) -> list[tuple[int, str, bytes]]:
+        for attempt in range(IMAGE_RANGE_RETRIES + 1):
+            try:
+                return get_image_range(self.connection_id, self.state, since, until)[1]
+            except requests.RequestException as e:
+                print(f"Error fetching images {since + 1}-{until} (attempt {attempt + 1}): {e}")
+        return []
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def get_images(
+    connection_id: str, state: str, color: bool = True, reduction: int = 1
+) -> "list[np.ndarray]":
+    """Decoded images, grayscale and/or at 1/2, 1/4 or 1/8 resolution to save memory, see decode.py."""
+    from decode import decode_image
+
+    images = []
+    for fname, img_bytes in get_image_bytes(connection_id, state):
+        try:
+            images.append(decode_image(img_bytes, reduction, color))
+        except ValueError:
+            raise Exception(f"Could not decode {fname} into a OpenCV image")
 
     return images
@@ -0,0 +1,42 @@
+from typing import Optional
+import cv2
+import numpy as np
+from constants import CHESSBOARD
+from decode import decode_image, jpeg_size, reduction_for, to_full_resolution
+
+# cv2 wants (points per row, points per column)
+CHESSBOARD_PATTERN_SIZE = (CHESSBOARD[1], CHESSBOARD[0])
+CHESSBOARD_FLAGS = (
+    cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+
+def find_chessboard_corners(gray: np.ndarray) -> Optional[np.ndarray]:
+    found, corners = cv2.findChessboardCorners(gray, CHESSBOARD_PATTERN_SIZE, flags=CHESSBOARD_FLAGS)
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), SUBPIX_CRITERIA)
+
+
+# runs in the pipeline's process pool, only the encoded bytes, the corners and the (width, height)
+# the calibration planner needs cross the process boundary
+def process_calibration_frame(image_bytes: bytes) -> tuple[Optional[np.ndarray], tuple[int, int]]:
+    # the chessboard is found on a reduced decode of large photos, the full resolution image is
+    # only decoded to refine the corners found
+    reduction = reduction_for(jpeg_size(image_bytes))
+    gray = decode_image(image_bytes, reduction)
+    corners = find_chessboard_corners(gray)
+    if reduction == 1:
+        return corners, (gray.shape[1], gray.shape[0])
+
+    if corners is None:
+        # a miss only needs the size roughly (within reduction - 1 px), no full decode for it
+        return None, (gray.shape[1] * reduction, gray.shape[0] * reduction)
+
+    del gray
+    gray = decode_image(image_bytes)
+    corners = cv2.cornerSubPix(
+        gray, to_full_resolution(corners, reduction), (11, 11), (-1, -1), SUBPIX_CRITERIA
+    )
+    return corners, (gray.shape[1], gray.shape[0])
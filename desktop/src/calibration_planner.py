@@ -0,0 +1,150 @@
+# Calibration planner: decides where the chessboard goes next and when there are enough photos.
+#
+# Every detected chessboard is binned into
+# - coverage: which cells of a COVERAGE_GRID over the photo have corners in them, lens distortion
+#   is strongest towards the edges and is only constrained where corners were seen
+# - tilt: how foreshortened the board is (opposite edge length ratio), a fronto-parallel board
+#   alone can't separate focal length from distance
+# and the board on screen is moved towards the emptiest cell, scaled by how large the board looks
+# in the photo, so the next photo fills a gap instead of repeating the last one. The phone moves
+# on to the next stage (directive next_state) as soon as coverage, tilt variety and the
+# reprojection error of a trial calibration all reach their targets.
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+from constants import CHESSBOARD, CHESSBOARD_SIZE
+
+COVERAGE_GRID = (4, 4)  # rows, cols over the photo
+TARGET_COVERAGE = 0.75  # of the cells
+TILT_BINS = (0.05, 0.15)  # |log(edge length ratio)| edges, below the first is fronto-parallel
+TARGET_TILT_BINS = 2
+TARGET_RMS = 0.5  # px reprojection error
+MIN_FRAMES = 4
+MAX_FRAMES = 20  # stop even if targets aren't met, more photos rarely help past this
+MAX_MISSES = 2  # photos in a row without a chessboard before it's made smaller and centered
+BOARD_GROWTH = 1.25
+MIN_BOARD_EXTENT = 0.3  # of the photo width, smaller boards are grown
+
+
+@dataclass(frozen=True)
+class BoardPlacement:
+    center: tuple[float, float] = (0.5, 0.5)  # fraction of the window
+    size: float = CHESSBOARD_SIZE  # mm, board width
+
+
+class CalibrationPlanner:
+    def __init__(self):
+        self.placement = BoardPlacement()
+        self.coverage = np.zeros(COVERAGE_GRID, dtype=np.int32)
+        self.tilts = np.zeros(len(TILT_BINS) + 1, dtype=np.int32)
+        self.image_points: list[np.ndarray] = []
+        self.image_size: Optional[tuple[int, int]] = None
+        self.frames = 0
+        self.misses = 0
+        self.rms: Optional[float] = None
+        self.camera_matrix: Optional[np.ndarray] = None
+        self.dist_coeffs: Optional[np.ndarray] = None
+        self.window_size_mm: Optional[tuple[float, float]] = None  # reported by the screen with the placement
+
+    @property
+    def coverage_fraction(self) -> float:
+        return float((self.coverage > 0).mean())
+
+    @property
+    def done(self) -> bool:
+        if self.frames >= MAX_FRAMES:
+            return True
+        return (
+            len(self.image_points) >= MIN_FRAMES
+            and self.coverage_fraction >= TARGET_COVERAGE
+            and int((self.tilts > 0).sum()) >= TARGET_TILT_BINS
+            and self.rms is not None
+            and self.rms <= TARGET_RMS
+        )
+
+    def add_frame(self, corners: Optional[np.ndarray], image_size: tuple[int, int]) -> Optional[BoardPlacement]:
+        """Records a photo's chessboard corners (or None), returns where the board should go next if it moves."""
+        self.frames += 1
+        if corners is None:
+            self.misses += 1
+            if self.misses < MAX_MISSES or self.placement == BoardPlacement():
+                return None
+            # probably out of the photo or too small to find, start over from the default
+            self.misses = 0
+            return BoardPlacement()
+        self.misses = 0
+
+        points = corners.reshape(-1, 2)
+        self.image_size = image_size
+        self.image_points.append(points.astype(np.float32))
+        self._record_coverage(points, image_size)
+        self.tilts[np.searchsorted(TILT_BINS, board_tilt(points))] += 1
+        if len(self.image_points) >= MIN_FRAMES:
+            self._calibrate()
+
+        if self.done:
+            return None
+        return self._next_placement(points, image_size)
+
+    def _record_coverage(self, points: np.ndarray, image_size: tuple[int, int]) -> None:
+        rows, cols = COVERAGE_GRID
+        cell_x = np.clip((points[:, 0] / image_size[0] * cols).astype(int), 0, cols - 1)
+        cell_y = np.clip((points[:, 1] / image_size[1] * rows).astype(int), 0, rows - 1)
+        np.add.at(self.coverage, (cell_y, cell_x), 1)
+
+    def _next_placement(self, points: np.ndarray, image_size: tuple[int, int]) -> BoardPlacement:
+        rows, cols = COVERAGE_GRID
+        size = np.array(image_size, dtype=np.float64)
+        board_min, board_max = points.min(axis=0) / size, points.max(axis=0) / size
+        board_center = (board_min + board_max) / 2
+        board_extent = board_max - board_min
+
+        # emptiest cell, ties broken by the one furthest from where the board is now
+        cell_centers = np.stack(
+            np.meshgrid((np.arange(cols) + 0.5) / cols, (np.arange(rows) + 0.5) / rows), axis=-1
+        )
+        distance = np.linalg.norm(cell_centers - board_center, axis=-1)
+        score = self.coverage - distance / (2 * distance.max() + 1e-9)
+        target = cell_centers[np.unravel_index(np.argmin(score), score.shape)]
+
+        # photo fractions => window fractions through how much of the photo the board covers versus
+        # how much of the window it covers, assumes the phone is roughly upright
+        size_mm = self.placement.size
+        if board_extent[0] < MIN_BOARD_EXTENT:
+            size_mm *= BOARD_GROWTH
+        window_fraction = np.full(2, 0.5)  # a guess until the screen reports its size
+        if self.window_size_mm:
+            board_size_mm = np.array([self.placement.size, self.placement.size * board_aspect()])
+            window_fraction = board_size_mm / np.array(self.window_size_mm)
+        photo_per_window = np.maximum(board_extent / window_fraction, 1e-3)
+        center = np.array(self.placement.center) + (target - board_center) / photo_per_window
+        return BoardPlacement((float(center[0]), float(center[1])), float(size_mm))
+
+    def placement_applied(self, placement: BoardPlacement, window_size_mm: tuple[float, float]) -> None:
+        # what the screen shows after fitting the request to the window
+        self.placement = placement
+        self.window_size_mm = window_size_mm
+
+    def _calibrate(self) -> None:
+        import cv2
+
+        rows, cols = CHESSBOARD
+        object_points = np.zeros((rows * cols, 3), dtype=np.float32)
+        object_points[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2)
+        self.rms, self.camera_matrix, self.dist_coeffs, _, _ = cv2.calibrateCamera(
+            [object_points] * len(self.image_points), self.image_points, self.image_size, None, None
+        )
+
+
+def board_aspect() -> float:
+    """Height / width of the rendered board, see markers.make_chessboard_img."""
+    return (CHESSBOARD[0] + 1) / (CHESSBOARD[1] + 1)
+
+
+def board_tilt(points: np.ndarray) -> float:
+    """|log| of the largest opposite edge length ratio of the detected corner grid, 0 when fronto-parallel."""
+    rows, cols = CHESSBOARD
+    tl, tr, bl, br = points[0], points[cols - 1], points[(rows - 1) * cols], points[-1]
+    left, right = np.linalg.norm(bl - tl), np.linalg.norm(br - tr)
+    top, bottom = np.linalg.norm(tr - tl), np.linalg.norm(br - bl)
+    return float(max(abs(np.log(left / right)), abs(np.log(top / bottom))))
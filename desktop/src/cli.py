@@ -0,0 +1,113 @@
+# Terminal entry point for machines where a Qt window just to show a QR code is overkill
+# (scripted setups, fleet-managed machines, ssh sessions). Pairing happens entirely in the
+# terminal and Qt/OpenCV are only imported once a pattern actually has to be drawn on screen.
+#
+# Usage: python3 ./desktop/src/cli.py [--ascii] [--poll-interval SECONDS]
+import argparse
+import sys
+import time
+from typing import Optional, TextIO
+import api
+from qr import qr_code_matrix
+
+ANSI_RESET = "\x1b[0m"
+ANSI_FG = {True: "\x1b[30m", False: "\x1b[97m"}  # dark module => black, light => white
+ANSI_BG = {True: "\x1b[40m", False: "\x1b[107m"}
+UPPER_HALF_BLOCK = "▀"
+
+# (top dark, bottom dark) => glyph, assumes light text on a dark terminal background
+ASCII_HALF_BLOCKS = {
+    (False, False): "█",
+    (False, True): "▀",
+    (True, False): "▄",
+    (True, True): " ",
+}
+
+
+def make_qr_code_matrix(connection_id: str) -> list[list[bool]]:
+    # the same cached matrix the Qt QR screen scales, see qr.py
+    return [list(row) for row in qr_code_matrix(connection_id)]
+
+
+def render_qr_code_terminal(matrix: list[list[bool]], ansi: bool = True) -> str:
+    # two module rows per terminal line so the modules come out roughly square
+    rows = list(matrix)
+    if len(rows) % 2:
+        rows.append([False] * len(rows[0]))
+
+    lines = []
+    for top, bottom in zip(rows[0::2], rows[1::2]):
+        if ansi:
+            line = "".join(
+                f"{ANSI_FG[t]}{ANSI_BG[b]}{UPPER_HALF_BLOCK}" for t, b in zip(top, bottom)
+            )
+            lines.append(line + ANSI_RESET)
+        else:
+            lines.append("".join(ASCII_HALF_BLOCKS[(t, b)] for t, b in zip(top, bottom)))
+
+    return "\n".join(lines)
+
+
+def qr_code_cli(connection_id: str, ansi: bool = True, out: TextIO = sys.stdout) -> None:
+    print(render_qr_code_terminal(make_qr_code_matrix(connection_id), ansi), file=out)
+    print(f"Scan the QR code with the Display Organizer app (connection {connection_id})", file=out)
+    out.flush()
+
+
+def finish_screen_cli(connection_id: str, out: TextIO = sys.stdout) -> None:
+    print(f"Display organization finished for connection {connection_id}", file=out)
+    out.flush()
+
+
+def wait_for_mobile_device(connection_id: str, poll_interval: float) -> Optional[str]:
+    while True:
+        status = api.get_connected_mobile_device_id(connection_id, wait=api.LONG_POLL_WAIT)
+        if status.connected:
+            return status.device_id
+        time.sleep(poll_interval)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Display Organizer (terminal pairing)")
+    parser.add_argument(
+        "--ascii",
+        action="store_true",
+        help="draw the QR code with plain block characters instead of ANSI colors",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.5,
+        help="seconds between connection status checks while pairing, on top of the bridge's long-poll",
+    )
+    args = parser.parse_args(argv)
+
+    connection_id = api.create_connection()
+    qr_code_cli(connection_id, ansi=not args.ascii and sys.stdout.isatty())
+
+    paired = False
+    try:
+        device_id = wait_for_mobile_device(connection_id, args.poll_interval)
+        paired = True
+    except KeyboardInterrupt:
+        print("Exiting app")
+        return 1
+    finally:
+        # a failed long-poll mustn't leave the connection (and the QR code) live on the bridge
+        if not paired:
+            api.end_connection(connection_id)
+
+    print(f"Connected to device ID: {device_id}")
+
+    # Qt (and OpenCV through the screens) is only needed from here on to draw the patterns
+    from main import App
+
+    app = App(connection_id=connection_id, device_id=device_id)
+    app.start()
+
+    finish_screen_cli(connection_id)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# JPEG decoding sized to what detection needs.
+#
+# Phones upload 12-48MP JPEGs, a 48MP frame is ~150MB as BGR and ~48MB as grayscale, and running
+# detection over all of it multiplies that by the detector's working images. Frames are decoded
+# grayscale only, and at 1/2, 1/4 or 1/8 resolution (IMREAD_REDUCED_*, libjpeg skips the DCT work
+# instead of resizing afterwards) when they are larger than DETECT_MAX_PIXELS. Detection runs on
+# the reduced image and only the found corners are refined at full resolution, see
+# rectify.detect_markers_coarse_to_fine and calibration.process_calibration_frame.
+#
+# The image size is read from the JPEG header, so the reduction and the memory a frame will need
+# (frame_memory, what FramePipeline's memory budget counts) are known before decoding anything.
+import struct
+from typing import Optional
+import numpy as np
+
+DETECT_MAX_PIXELS = 8_000_000  # coarse detection resolution cap, 12MP photos are detected at 1/2
+DETECT_WORKING_COPIES = 6  # full size buffers the detectors allocate (thresholds, contours...) per input image
+REDUCTIONS = (1, 2, 4, 8)
+
+# cv2.IMREAD_* values, so choosing a reduction doesn't need cv2 loaded
+_IMREAD_GRAYSCALE = 0
+_IMREAD_COLOR = 1
+_IMREAD_REDUCED = {  # reduction => (grayscale, color)
+    2: (16, 17),
+    4: (32, 33),
+    8: (64, 65),
+}
+
+# start of frame markers holding the image size, every SOFn except DHT (C4), JPG (C8) and DAC (CC)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(image_bytes: bytes) -> Optional[tuple[int, int]]:
+    """(width, height) from the JPEG header, None when it isn't a JPEG this can read."""
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 4 <= len(image_bytes):
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # no length
+            i += 2
+            continue
+        (length,) = struct.unpack(">H", image_bytes[i + 2 : i + 4])
+        if marker in _SOF_MARKERS:
+            if i + 9 > len(image_bytes):
+                return None
+            height, width = struct.unpack(">HH", image_bytes[i + 5 : i + 9])
+            return width, height
+        if marker == 0xDA:  # start of scan without a frame header
+            return None
+        i += 2 + length
+    return None
+
+
+def reduction_for(size: Optional[tuple[int, int]], max_pixels: int = DETECT_MAX_PIXELS) -> int:
+    """Smallest of REDUCTIONS that brings size under max_pixels (1 when the size is unknown)."""
+    if size is None:
+        return 1
+    pixels = size[0] * size[1]
+    for reduction in REDUCTIONS:
+        if pixels / reduction**2 <= max_pixels:
+            return reduction
+    return REDUCTIONS[-1]
+
+
+def decode_image(image_bytes: bytes, reduction: int = 1, color: bool = False) -> np.ndarray:
+    import cv2
+
+    if reduction == 1:
+        flags = _IMREAD_COLOR if color else _IMREAD_GRAYSCALE
+    else:
+        flags = _IMREAD_REDUCED[reduction][color]
+    img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+    if img is None:
+        raise ValueError("Could not decode image into a OpenCV image")
+    return img
+
+
+def to_full_resolution(points: np.ndarray, reduction: int) -> np.ndarray:
+    # pixel i of the reduced image covers full resolution pixels [i * r, (i + 1) * r)
+    if reduction == 1:
+        return points
+    return ((points + 0.5) * reduction - 0.5).astype(points.dtype)
+
+
+def frame_memory(image_bytes: bytes, max_pixels: int = DETECT_MAX_PIXELS) -> int:
+    """Estimated peak bytes for decoding and detecting one frame: the encoded bytes, the reduced
+    image and the detector's working copies of it, and the full resolution image for refinement."""
+    size = jpeg_size(image_bytes)
+    if size is None:
+        # not a JPEG we can read, assume a typical ~10:1 compression ratio and no reduction
+        pixels = 10 * len(image_bytes)
+        return len(image_bytes) + pixels * (1 + DETECT_WORKING_COPIES)
+    pixels = size[0] * size[1]
+    reduced = pixels // reduction_for(size, max_pixels) ** 2
+    return len(image_bytes) + reduced * (1 + DETECT_WORKING_COPIES) + (pixels if reduced < pixels else 0)
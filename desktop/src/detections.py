@@ -0,0 +1,117 @@
+# Columnar marker detections and a ring buffer of the last N frames.
+#
+# Each frame is a row of preallocated arrays instead of a list of (1, 4, 2) arrays plus an ids
+# array (what ArucoDetector.detectMarkers returns) or a dict per frame:
+#   frame_ids   (F,)          frame id stored in each slot, -1 when empty
+#   counts      (F,)          markers detected in each slot
+#   marker_ids  (F, M)        detected marker ids, -1 padding
+#   corners     (F, M, 4, 2)  their corners, NaN padding
+#   columns     (F, ids)      column of each marker id in a slot, -1 when not detected
+# The id => column table is what lets any set of marker ids (every screen's four corner markers)
+# be gathered for every buffered frame with one fancy index, so fusion over frames and screens
+# stays vectorized and pushing a frame writes into existing rows instead of allocating new ones.
+from typing import Optional, Sequence
+import numpy as np
+from constants import ARUCO_TAG_COUNT
+
+RING_CAPACITY = 32  # frames
+
+
+def marker_table(
+    ids: np.ndarray, corners: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """(ARUCO_TAG_COUNT, 4, 2) corners indexed by marker id, NaN for markers that weren't detected."""
+    if out is None:
+        out = np.empty((ARUCO_TAG_COUNT, 4, 2), dtype=np.float32)
+    out.fill(np.nan)
+    valid = (ids >= 0) & (ids < ARUCO_TAG_COUNT)
+    out[ids[valid]] = corners[valid]
+    return out
+
+
+def from_detector(corners: Sequence[np.ndarray], ids: Optional[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """(n,) ids and (n, 4, 2) corners from what ArucoDetector.detectMarkers returns."""
+    if ids is None or len(corners) == 0:
+        return np.empty(0, dtype=np.int32), np.empty((0, 4, 2), dtype=np.float32)
+    return ids.ravel().astype(np.int32), np.concatenate(corners, axis=0).reshape(-1, 4, 2)
+
+
+class DetectionRing:
+    def __init__(self, capacity: int = RING_CAPACITY, max_markers: int = ARUCO_TAG_COUNT):
+        self.capacity = capacity
+        self.max_markers = max_markers
+        self.frame_ids = np.full(capacity, -1, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.int32)
+        self.marker_ids = np.full((capacity, max_markers), -1, dtype=np.int32)
+        self.corners = np.full((capacity, max_markers, 4, 2), np.nan, dtype=np.float32)
+        self.columns = np.full((capacity, ARUCO_TAG_COUNT), -1, dtype=np.int16)
+        self._column_numbers = np.arange(max_markers, dtype=np.int16)
+        self.head = 0  # slot the next frame goes into
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def clear(self) -> None:
+        self.frame_ids.fill(-1)
+        self.counts.fill(0)
+        self.marker_ids.fill(-1)
+        self.corners.fill(np.nan)
+        self.columns.fill(-1)
+        self.head = self.size = 0
+
+    def push(self, frame_id: int, ids: np.ndarray, corners: np.ndarray) -> int:
+        """Stores a frame's (n,) ids and (n, 4, 2) corners over the oldest frame, returns its slot."""
+        slot = self.head
+        previous = self.counts[slot]
+        n = min(len(ids), self.max_markers)
+
+        # only the part of the row the overwritten frame used needs resetting
+        self.marker_ids[slot, n:previous] = -1
+        self.corners[slot, n:previous] = np.nan
+        self.columns[slot] = -1
+
+        self.frame_ids[slot] = frame_id
+        self.counts[slot] = n
+        self.marker_ids[slot, :n] = ids[:n]
+        self.corners[slot, :n] = corners[:n]
+        valid = (ids[:n] >= 0) & (ids[:n] < ARUCO_TAG_COUNT)
+        self.columns[slot, ids[:n][valid]] = self._column_numbers[:n][valid]
+
+        self.head = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return slot
+
+    def push_detector(self, frame_id: int, corners: Sequence[np.ndarray], ids: Optional[np.ndarray]) -> int:
+        return self.push(frame_id, *from_detector(corners, ids))
+
+    def slots(self, last: Optional[int] = None) -> np.ndarray:
+        """Slots of the last frames, oldest first."""
+        count = self.size if last is None else min(last, self.size)
+        return (self.head - count + np.arange(count)) % self.capacity
+
+    def marker_corners(self, marker_ids: np.ndarray, last: Optional[int] = None) -> np.ndarray:
+        """(frames, *marker_ids.shape, 4, 2) corners of the given marker ids, NaN where not detected."""
+        marker_ids = np.asarray(marker_ids)
+        slots = self.slots(last)
+        columns = self.columns[slots][:, marker_ids.ravel()]  # (frames, K)
+        gathered = self.corners[slots[:, None], np.maximum(columns, 0)]
+        gathered[columns < 0] = np.nan
+        return gathered.reshape((len(slots),) + marker_ids.shape + (4, 2))
+
+    def screen_quads(self, screens: np.ndarray, last: Optional[int] = None) -> np.ndarray:
+        """(frames, S, 4, 2) outer screen corners from (S, 4) tl, tr, br, bl marker ids per screen.
+
+        Corner k of the marker in position k, like rectify.screen_quads, NaN if any is missing.
+        """
+        screens = np.asarray(screens)
+        markers = self.marker_corners(screens, last)  # (frames, S, 4 markers, 4 corners, 2)
+        k = np.arange(4)
+        quads = markers[:, :, k, k]
+        quads[np.isnan(quads).any(axis=(2, 3))] = np.nan
+        return quads
+
+    def frame(self, slot: int) -> tuple[np.ndarray, np.ndarray]:
+        """Views of the ids and corners stored in a slot."""
+        n = self.counts[slot]
+        return self.marker_ids[slot, :n], self.corners[slot, :n]
@@ -0,0 +1,139 @@
+# Append-only on-disk store for the frames received from the phone.
+#
+# <dir>/frames.bin    original encoded bytes (the JPEG exactly as the phone sent it), back to back
+# <dir>/corners.f32   float32 (x, y) detection points, back to back
+# <dir>/index.bin     one INDEX_DTYPE record per frame pointing into the two files above
+#
+# Records are only appended after the bytes they point to are written, so a crash can at worst
+# leave unreferenced bytes at the end of frames.bin/corners.f32, never a broken index.
+# The index and the corners can be memory-mapped to reload detections without decoding images.
+import os
+import queue
+import threading
+from typing import Optional
+import numpy as np
+
+MAX_NAME_BYTES = 64
+INDEX_DTYPE = np.dtype(
+    [
+        ("name", f"S{MAX_NAME_BYTES}"),
+        ("offset", "<u8"),
+        ("length", "<u8"),
+        ("corners_offset", "<u8"),  # in points, not bytes
+        ("corners_count", "<u4"),  # 0 when nothing was detected
+    ]
+)
+FRAMES_FILE = "frames.bin"
+CORNERS_FILE = "corners.f32"
+INDEX_FILE = "index.bin"
+
+
+class FrameStore:
+    """Writes frames and their detections from a background thread, append() never touches disk."""
+
+    def __init__(self, path: str, max_queued: int = 64):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self._frames = open(os.path.join(path, FRAMES_FILE), "ab")
+        self._corners = open(os.path.join(path, CORNERS_FILE), "ab")
+        self._index = open(os.path.join(path, INDEX_FILE), "ab")
+
+        self._queue: queue.Queue[Optional[tuple[str, bytes, Optional[np.ndarray]]]] = queue.Queue(
+            maxsize=max_queued
+        )
+        # nothing may be queued behind the sentinel, the writer never reads it
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, name="frame-store-writer", daemon=True)
+        self._writer.start()
+
+    def append(self, name: str, image_bytes: bytes, corners: Optional[np.ndarray] = None) -> None:
+        """Raises RuntimeError once the store is closed, ValueError for names the index can't hold."""
+        if len(name.encode()) > MAX_NAME_BYTES:
+            # the fixed width name column would cut it off without a word
+            raise ValueError(f"Frame name {name!r} is longer than {MAX_NAME_BYTES} bytes")
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError(f"FrameStore {self.path} is closed, {name} was not written")
+            self._queue.put((name, image_bytes, corners))
+
+    def close(self) -> None:
+        """Waits for queued frames to be written."""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self) -> None:
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    print(f"Error writing frame {item[0]}: {e}")
+        finally:
+            self._frames.close()
+            self._corners.close()
+            self._index.close()
+
+    def _write(self, name: str, image_bytes: bytes, corners: Optional[np.ndarray]) -> None:
+        offset = self._frames.tell()
+        self._frames.write(image_bytes)
+        self._frames.flush()
+
+        corners_offset = self._corners.tell() // (2 * 4)
+        corners_count = 0
+        if corners is not None:
+            points = np.ascontiguousarray(corners, dtype="<f4").reshape(-1, 2)
+            self._corners.write(points.tobytes())
+            self._corners.flush()
+            corners_count = len(points)
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record[0] = (name.encode(), offset, len(image_bytes), corners_offset, corners_count)
+        self._index.write(record.tobytes())
+        self._index.flush()
+
+
+class FrameStoreReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.index = _memmap(os.path.join(path, INDEX_FILE), INDEX_DTYPE)
+        self.points = _memmap(os.path.join(path, CORNERS_FILE), np.dtype("<f4")).reshape(-1, 2)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def names(self) -> list[str]:
+        return [name.decode() for name in self.index["name"]]
+
+    def corners(self, i: int) -> Optional[np.ndarray]:
+        record = self.index[i]
+        if record["corners_count"] == 0:
+            return None
+        start = int(record["corners_offset"])
+        return self.points[start : start + int(record["corners_count"])]
+
+    def detected(self) -> np.ndarray:
+        """Indices of the frames that have detections."""
+        return np.flatnonzero(self.index["corners_count"] > 0)
+
+    def image_bytes(self, i: int) -> bytes:
+        record = self.index[i]
+        with open(os.path.join(self.path, FRAMES_FILE), "rb") as f:
+            f.seek(int(record["offset"]))
+            return f.read(int(record["length"]))
+
+
+def _memmap(path: str, dtype: np.dtype) -> np.ndarray:
+    # np.memmap refuses empty files
+    if not os.path.exists(path) or os.path.getsize(path) < dtype.itemsize:
+        return np.zeros(0, dtype=dtype)
+    count = os.path.getsize(path) // dtype.itemsize
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
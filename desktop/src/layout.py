@@ -0,0 +1,167 @@
+# Snapping measured display rectangles into a wall where neighbouring edges touch.
+#
+# Rectangles are an (N, 4) array of [x0, y0, x1, y1]. All pairwise quantities are computed at once
+# with broadcasting into (N, N) arrays, and the snap is solved as one least-squares problem over
+# every display's translation: each pair of neighbours contributes "the gap between these two edges
+# is zero", the anchor display (the main screen) stays put and every other display is pulled
+# towards not moving at all. This replaces chaining pairwise aabb_mvt moves from
+# marker_align_test.py, where the order of the moves changed the result.
+from typing import Optional
+import numpy as np
+
+SNAP_TOLERANCE = 0.25  # of the smaller display's extent, gaps/overlaps up to this are snapped
+STAY_WEIGHT = 1e-3  # how strongly displays without constraints on an axis stay where they are
+NO_AXIS, X_AXIS, Y_AXIS = -1, 0, 1
+
+
+def pairwise_overlaps(rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(N, N) overlap along x and y, negative values are the gap between the two."""
+    x0, y0, x1, y1 = (rects[:, k] for k in range(4))
+    overlap_x = np.minimum(x1[:, None], x1[None, :]) - np.maximum(x0[:, None], x0[None, :])
+    overlap_y = np.minimum(y1[:, None], y1[None, :]) - np.maximum(y0[:, None], y0[None, :])
+    return overlap_x, overlap_y
+
+
+def pairwise_touch_offsets(rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(N, N) translation of display j along x and y that makes it touch display i on the side it's on."""
+    x0, y0, x1, y1 = (rects[:, k] for k in range(4))
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    right_of = cx[None, :] >= cx[:, None]
+    below = cy[None, :] >= cy[:, None]
+    dx = np.where(right_of, x1[:, None] - x0[None, :], x0[:, None] - x1[None, :])
+    dy = np.where(below, y1[:, None] - y0[None, :], y0[:, None] - y1[None, :])
+    return dx, dy
+
+
+def minimum_translations(rects: np.ndarray) -> np.ndarray:
+    """(N, N, 2) smallest translation of display j that makes it touch display i, along one axis.
+
+    The vectorized version of aabb_mvt: overlapping pairs are pushed apart, separated pairs are
+    pulled together, along whichever axis needs the shorter move.
+    """
+    overlap_x, overlap_y = pairwise_overlaps(rects)
+    dx, dy = pairwise_touch_offsets(rects)
+    # only touching along an axis where the other axis is shared makes them neighbours,
+    # fully diagonal pairs fall back to the shorter move
+    can_x, can_y = overlap_y > 0, overlap_x > 0
+    both_or_neither = can_x == can_y
+    use_x = np.where(both_or_neither, np.abs(dx) <= np.abs(dy), can_x)
+
+    translations = np.zeros(rects.shape[:1] * 2 + (2,))
+    translations[..., 0] = np.where(use_x, dx, 0)
+    translations[..., 1] = np.where(use_x, 0, dy)
+    return translations
+
+
+def adjacency(rects: np.ndarray, tolerance: float = SNAP_TOLERANCE) -> tuple[np.ndarray, np.ndarray]:
+    """(N, N) axis each pair of neighbours touches along (or NO_AXIS) and the signed move to get there."""
+    overlap_x, overlap_y = pairwise_overlaps(rects)
+    dx, dy = pairwise_touch_offsets(rects)
+    width = rects[:, 2] - rects[:, 0]
+    height = rects[:, 3] - rects[:, 1]
+    max_dx = tolerance * np.minimum(width[:, None], width[None, :])
+    max_dy = tolerance * np.minimum(height[:, None], height[None, :])
+
+    near_x = (overlap_y > 0) & (np.abs(dx) <= max_dx)
+    near_y = (overlap_x > 0) & (np.abs(dy) <= max_dy)
+    prefer_x = near_x & (~near_y | (np.abs(dx) / max_dx <= np.abs(dy) / max_dy))
+
+    axis = np.where(prefer_x, X_AXIS, np.where(near_y, Y_AXIS, NO_AXIS))
+    np.fill_diagonal(axis, NO_AXIS)
+    move = np.where(axis == X_AXIS, dx, np.where(axis == Y_AXIS, dy, 0.0))
+    return axis, move
+
+
+def connected_components(adjacent: np.ndarray) -> np.ndarray:
+    """(N,) component label of each node, the smallest node index in it."""
+    n = len(adjacent)
+    reach = adjacent | adjacent.T | np.eye(n, dtype=bool)
+    # transitive closure by repeated squaring, log2(N) boolean matrix products
+    for _ in range(max(1, int(np.ceil(np.log2(max(n, 2)))))):
+        # int32, a uint8 product wraps at 256 and a full row of 256 displays would sum to 0
+        reach = (reach.astype(np.int32) @ reach.astype(np.int32)) > 0
+    return np.argmax(reach, axis=1)
+
+
+def snap_layout(
+    rects: np.ndarray,
+    anchor: int = 0,
+    tolerance: float = SNAP_TOLERANCE,
+    axis: Optional[np.ndarray] = None,
+    move: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """(N, 2) translations that make neighbouring displays touch, with rects[anchor] fixed.
+
+    Displays that aren't within the tolerance of any other display are attached to the rest of
+    the wall through their closest neighbour, so the result is always one connected layout:
+    along one axis when the two share an extent on the other, corner to corner (snapped on
+    both axes) when they're only diagonal neighbours.
+    """
+    rects = np.asarray(rects, dtype=np.float64)
+    n = len(rects)
+    if n < 2:
+        return np.zeros((n, 2))
+
+    if axis is None or move is None:
+        axis, move = adjacency(rects, tolerance)
+    axis = axis.copy()
+    move = move.copy()
+    corners = _connect_components(rects, axis, move)
+
+    # each constraint row: t_j - t_i = move[i, j] along its axis, i < j to count every pair once
+    i, j = np.nonzero(np.triu(axis != NO_AXIS, k=1))
+    translations = np.zeros((n, 2))
+    for ax in (X_AXIS, Y_AXIS):
+        rows = axis[i, j] == ax
+        # corner to corner pairs also need the gap on their other axis closed
+        extra = [(ci, cj, value) for ci, cj, other_ax, value in corners if other_ax == ax]
+        ci = np.concatenate([i[rows], np.array([c[0] for c in extra], dtype=int)])
+        cj = np.concatenate([j[rows], np.array([c[1] for c in extra], dtype=int)])
+        m = len(ci)
+
+        a = np.zeros((m + n, n))
+        b = np.zeros(m + n)
+        a[np.arange(m), cj] = 1.0
+        a[np.arange(m), ci] = -1.0
+        b[:m] = np.concatenate([move[i[rows], j[rows]], [c[2] for c in extra]])
+        # every display prefers to stay, the anchor insists on it
+        a[m + np.arange(n), np.arange(n)] = STAY_WEIGHT
+        a[m + anchor, anchor] = 1e6
+
+        translations[:, ax] = np.linalg.lstsq(a, b, rcond=None)[0]
+
+    translations -= translations[anchor]
+    return translations
+
+
+def _connect_components(
+    rects: np.ndarray, axis: np.ndarray, move: np.ndarray
+) -> list[tuple[int, int, int, float]]:
+    # adds the cheapest constraint between a component and the rest until everything is connected,
+    # returns (i, j, axis, move) for the second axis of the pairs that only meet corner to corner
+    minimum = minimum_translations(rects)
+    cost = np.abs(minimum).sum(axis=2)
+    overlap_x, overlap_y = pairwise_overlaps(rects)
+    dx, dy = pairwise_touch_offsets(rects)
+    corners = []
+    while True:
+        labels = connected_components(axis != NO_AXIS)
+        if (labels == labels[0]).all():
+            return corners
+
+        across = labels[:, None] != labels[None, :]
+        i, j = np.unravel_index(np.argmin(np.where(across, cost, np.inf)), cost.shape)
+        ax = X_AXIS if minimum[i, j, 0] != 0 or minimum[i, j, 1] == 0 else Y_AXIS
+        axis[i, j] = axis[j, i] = ax
+        move[i, j] = minimum[i, j, ax]
+        move[j, i] = minimum[j, i, ax]
+        if overlap_x[i, j] < 0 and overlap_y[i, j] < 0:
+            # diagonal neighbours, closing the gap on one axis would still leave one on the other
+            other = Y_AXIS if ax == X_AXIS else X_AXIS
+            offsets = dy if other == Y_AXIS else dx
+            a, b = min(i, j), max(i, j)
+            corners.append((a, b, other, float(offsets[a, b])))
+
+
+def snapped(rects: np.ndarray, translations: np.ndarray) -> np.ndarray:
+    return np.asarray(rects, dtype=np.float64) + np.tile(translations, 2)
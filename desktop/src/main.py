@@ -1,12 +1,22 @@
+# Startup is kept lean so the QR window shows up as fast as possible: only Qt and the screens
+# are imported up front, OpenCV and the network stack (requests, pydantic) are imported on
+# the worker thread when their stage runs. Run with --profile-startup to print the timings.
+from profiling import startup_profile
+import argparse
+import os
 import sys
-import time
+import threading
 from typing import Optional
-from PyQt6.QtWidgets import QApplication
-from PyQt6.QtCore import QObject, pyqtSignal, QTimer, QThread
-from screens import CalibrationScreen, OrganizationScreen, QRCodeScreen
-import cv2
-import api
-import uuid
+
+with startup_profile.measure("import", "PyQt6"):
+    from PyQt6.QtWidgets import QApplication
+    from PyQt6.QtCore import QObject, pyqtSignal, QTimer, QThread
+
+with startup_profile.measure("import", "screens"):
+    from screens import CalibrationScreen, OrganizationScreen, QRCodeScreen
+
+ORGANIZATION_TIMEOUT_MS = 120_000  # the phone keeps uploading while organizing, see mobile/app/index.tsx
+PAIRING_RETRY_SECONDS = 1.0  # after a failed long-poll
 
 def print_screen_info(app: QApplication) -> None:
     for screen in app.screens():
@@ -40,12 +50,14 @@ class App(QObject):
     calibration_screen: Optional[CalibrationScreen] = None
     organization_screen: Optional[OrganizationScreen] = None
 
-    def __init__(self):
+    def __init__(self, connection_id: Optional[str] = None, device_id: Optional[str] = None):
         super().__init__()
-        self.app = QApplication(sys.argv)
+        with startup_profile.measure("init", "QApplication"):
+            self.app = QApplication(sys.argv)
         self.app.setQuitOnLastWindowClosed(False)
         self.main_thread = QThread()
-        self.worker = MainWorker()
+        # connection_id (and the phone's device_id) are set when pairing already happened elsewhere (see cli.py)
+        self.worker = MainWorker(connection_id, device_id)
 
         self.worker.open_qrcode_screen.connect(self.open_qrcode_screen)
         self.worker.close_qrcode_screen.connect(self.close_qrcode_screen)
@@ -53,17 +65,35 @@ class App(QObject):
         self.worker.close_calibration_screen.connect(self.close_calibration_screen)
         self.worker.open_organization_screen.connect(self.open_organization_screen)
         self.worker.close_organization_screen.connect(self.close_organization_screen)
+        self.worker.update_organization_pattern.connect(self.update_organization_pattern)
+        self.worker.update_calibration_board.connect(self.update_calibration_board)
         self.worker.exit_app.connect(self.exit)
 
+        # show the QR window right away, the worker fills in the code once it has a connection id
+        if not connection_id:
+            self.open_qrcode_screen(None)
+
         self.worker.moveToThread(self.main_thread)
         self.main_thread.started.connect(self.worker.start)
         self.main_thread.start()
 
-    def open_qrcode_screen(self, connection_id: str) -> None:
-        qrcode_screen = QRCodeScreen(self.app, connection_id)
+    def open_qrcode_screen(self, connection_id: Optional[str]) -> None:
+        if self.qrcode_screen and connection_id:
+            self.qrcode_screen.set_connection_id(connection_id)
+            QTimer.singleShot(0, lambda: self._mark_startup("qr code visible"))
+            return
+
+        with startup_profile.measure("init", "QRCodeScreen"):
+            qrcode_screen = QRCodeScreen(self.app, connection_id)
         qrcode_screen.screen_close_requested.connect(lambda: self.worker.qrcode_screen_closed.emit()) # check if can just put in slot
         qrcode_screen.show()
         self.qrcode_screen = qrcode_screen
+        QTimer.singleShot(0, lambda: self._mark_startup("qr window visible"))
+
+    def _mark_startup(self, name: str) -> None:
+        startup_profile.mark(name)
+        if name == "qr code visible" and startup_profile.enabled:
+            startup_profile.report()
 
     def close_qrcode_screen(self) -> None:
         if self.qrcode_screen:
@@ -75,8 +105,14 @@ class App(QObject):
     def open_calibration_screen(self) -> None:
         calibration_screen = CalibrationScreen(self.app)
         calibration_screen.screen_close_requested.connect(lambda: self.worker.calibration_screen_closed.emit())
+        calibration_screen.board_placed.connect(self.worker.calibration_board_placed.emit)
         calibration_screen.showFullScreen()
         self.calibration_screen = calibration_screen
+        self.worker.calibration_board_placed.emit(calibration_screen.placement, calibration_screen.window_size_mm)
+
+    def update_calibration_board(self, placement) -> None:
+        if self.calibration_screen:
+            self.calibration_screen.set_board(placement)
 
     def close_calibration_screen(self) -> None:
         if self.calibration_screen:
@@ -87,8 +123,16 @@ class App(QObject):
     def open_organization_screen(self) -> None:
         organization_screen = OrganizationScreen(self.app)
         organization_screen.screen_close_requested.connect(lambda: self.worker.organization_screen_closed.emit())
+        organization_screen.pattern_applied.connect(self.worker.organization_pattern_applied.emit)
         organization_screen.show()
         self.organization_screen = organization_screen
+        # the worker judges detections against what each screen shows
+        for i, pattern in enumerate(organization_screen.patterns):
+            self.worker.organization_pattern_applied.emit(i, pattern)
+
+    def update_organization_pattern(self, screen_idx: int, pattern) -> None:
+        if self.organization_screen:
+            self.organization_screen.set_pattern(screen_idx, pattern)
 
     def close_organization_screen(self) -> None:
         if self.organization_screen:
@@ -114,66 +158,247 @@ class MainWorker(QObject):
     close_organization_screen = pyqtSignal()
     organization_screen_closed = pyqtSignal()
     exit_app = pyqtSignal()
+    # emitted from the pipeline's persist thread, delivered on the worker thread
+    calibration_frame_processed = pyqtSignal(str, object)
+    update_calibration_board = pyqtSignal(object)
+    calibration_board_placed = pyqtSignal(object, object)
+    organization_frame_processed = pyqtSignal(str, object)
+    update_organization_pattern = pyqtSignal(int, object)
+    organization_pattern_applied = pyqtSignal(int, object)
+    # emitted from the pairing thread with the phone's device id
+    mobile_connected = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, connection_id: Optional[str] = None, device_id: Optional[str] = None):
         super().__init__()
-        self.connection_id = None
+        self.connection_id = connection_id
         self.timer = QTimer(self)
-        self.calibration_images_received = 0
+        self.pairing_stopped = threading.Event()
+        self.pipeline = None
+        self.image_queue = None
+        self.frame_store = None
+        self.calibration_planner = None
+        self.device_id = device_id
+        # intrinsics of the phone's camera (undistort.CameraIntrinsics) once calibration is done
+        self.intrinsics = None
+        self.organization_feedback = None
+
+    def stop_pipeline(self):
+        if self.pipeline:
+            # doesn't wait, the fetch stage may be in a long-poll. A frame the persist stage still
+            # hands to the store after it's closed below is dropped, FrameStore.append raises and
+            # the pipeline reports it
+            self.pipeline.cancel()
+            self.pipeline = None
+        if self.image_queue:
+            self.image_queue.close()
+            self.image_queue = None
+        if self.frame_store:
+            self.frame_store.close()
+            self.frame_store = None
 
     def handle_close(self):
+        import api
+        import vision
+
         print("Exiting app")
+        self.pairing_stopped.set()
+        self.stop_pipeline()
+        vision.shutdown_service()
         api.end_connection(self.connection_id)
         self.exit_app.emit()
 
     def start(self):
-        self.connection_id = api.create_connection()
+        with startup_profile.measure("import", "api (requests, pydantic)"):
+            import api
+
+        if self.connection_id:
+            # already paired, go straight to the patterns
+            self.start_vision()
+            QTimer.singleShot(0, self.start_calibration)
+            return
+
+        with startup_profile.measure("init", "api.create_connection"):
+            self.connection_id = api.create_connection()
         self.open_qrcode_screen.emit(self.connection_id)
 
         self.qrcode_screen_closed.connect(self.handle_close)
-        self.timer.timeout.connect(self.check_connection)
-        self.timer.start(500)
+        self.mobile_connected.connect(self.handle_mobile_connected)
+        # long-polls off the worker thread so it stays free to handle the QR window closing
+        threading.Thread(target=self.wait_for_mobile_device, name="pairing", daemon=True).start()
 
-    def check_connection(self):
-        status = api.get_connected_mobile_device_id(self.connection_id)
-        if not status.connected:
-            return
+    def wait_for_mobile_device(self):
+        import api
+
+        while not self.pairing_stopped.is_set():
+            try:
+                status = api.get_connected_mobile_device_id(self.connection_id, wait=api.LONG_POLL_WAIT)
+            except Exception as e:
+                print(f"Error checking connection: {e}")
+                self.pairing_stopped.wait(PAIRING_RETRY_SECONDS)
+                continue
+            if status.connected:
+                if not self.pairing_stopped.is_set():
+                    self.mobile_connected.emit(status.device_id or "")
+                return
 
-        print(f"Connected to device ID: {status.device_id}")
+    def handle_mobile_connected(self, device_id: str):
+        print(f"Connected to device ID: {device_id}")
+        self.device_id = device_id or None
+        self.start_vision()
         self.close_qrcode_screen.emit()
-        self.timer.disconnect()
-        self.timer.stop()
         QTimer.singleShot(0, self.start_calibration)
 
+    def start_vision(self):
+        import vision
+
+        # workers import OpenCV and build their detectors while the phone starts taking photos
+        vision.get_service().warm_up(wait=False)
+
     def start_calibration(self):
+        import api
+        from calibration import process_calibration_frame
+        from calibration_planner import CalibrationPlanner
+        from decode import frame_memory
+        from frame_store import FrameStore
+        from pipeline import FramePipeline
+        from vision import get_service
+
+        self.calibration_planner = CalibrationPlanner()
+        self.calibration_board_placed.connect(self.record_calibration_board)
         self.open_calibration_screen.emit()
         api.set_connection_state(self.connection_id, "calibrating")
 
         self.calibration_screen_closed.connect(self.handle_close)
-        self.timer.timeout.connect(self.calibrate_camera)
-        self.timer.start(500)
+        self.calibration_frame_processed.connect(self.calibrate_camera)
+        # original JPEG bytes plus the detected chessboard corners, see frame_store.py
+        frame_store = FrameStore(os.path.join("calibration", self.connection_id))
+        self.frame_store = frame_store
+        self.image_queue = api.ImageQueue(self.connection_id, "calibrating")
+        self.pipeline = FramePipeline(
+            fetch=self.image_queue.fetch,
+            process=process_calibration_frame,
+            # bound to this store, stop_pipeline clears self.frame_store while late frames may still come in
+            persist=lambda name, data, result: frame_store.append(name, data, result[0]),
+            on_result=self.calibration_frame_processed.emit,
+            executor=get_service(),
+            frame_memory=frame_memory,
+        )
+        self.pipeline.start()
 
-    def calibrate_camera(self):
-        images = api.get_images(self.connection_id, "calibrating")
-        for img in images:
-            cv2.imwrite(f"calibration/{str(uuid.uuid4())}.jpg", img)
-            self.calibration_images_received += 1
+    def record_calibration_board(self, placement, window_size_mm):
+        if self.calibration_planner:
+            self.calibration_planner.placement_applied(placement, window_size_mm)
+            self.report_scene_change("calibrating")
 
-        print(f"Considered {self.calibration_images_received} images")
+    def calibrate_camera(self, name: str, result):
+        if not self.pipeline:
+            return  # frame finished after the stage ended
 
-        if self.calibration_images_received < 3:
+        corners, image_size = result
+        planner = self.calibration_planner
+        placement = planner.add_frame(corners, image_size)
+        print(
+            f"Considered {planner.frames} images ({name}: chessboard {'found' if corners is not None else 'not found'}, "
+            f"coverage {planner.coverage_fraction:.0%}, rms {planner.rms if planner.rms is not None else '-'})"
+        )
+        if placement:
+            self.update_calibration_board.emit(placement)
+
+        if not planner.done:
             return
 
+        # moving the connection to organizing is what tells the phone (directive next_state)
+        from undistort import CameraIntrinsics
+
+        if planner.camera_matrix is not None:
+            self.intrinsics = CameraIntrinsics(
+                planner.camera_matrix, planner.dist_coeffs, planner.image_size, self.device_id or "unknown"
+            )
+            self.intrinsics.save(os.path.join("calibration", self.connection_id))
+        else:
+            print("Camera not calibrated, marker corners won't be undistorted")
+        self.stop_pipeline()
+        self.calibration_frame_processed.disconnect()
         self.close_calibration_screen.emit()
-        self.timer.disconnect()
-        self.timer.stop()
         QTimer.singleShot(0, self.start_organization)
 
     def start_organization(self):
+        import api
+        from decode import frame_memory
+        from functools import partial
+        from organization import OrganizationFeedback, process_organization_frame
+        from pipeline import FramePipeline
+        from vision import get_service
+
+        self.organization_feedback = OrganizationFeedback()
+        self.organization_pattern_applied.connect(self.record_organization_pattern)
+        self.organization_frame_processed.connect(self.organize_displays)
+
         self.open_organization_screen.emit()
         api.set_connection_state(self.connection_id, "organizing")
-        QTimer.singleShot(5000, self.handle_close)
+        self.organization_screen_closed.connect(self.handle_close)
+
+        self.image_queue = api.ImageQueue(self.connection_id, "organizing")
+        self.pipeline = FramePipeline(
+            fetch=self.image_queue.fetch,
+            # marker corners are undistorted in the pool, next to the detection
+            process=partial(process_organization_frame, intrinsics=self.intrinsics),
+            # XXX: keep the frames once there is a layout solving stage to hand them to
+            persist=lambda name, data, markers: None,
+            on_result=self.organization_frame_processed.emit,
+            executor=get_service(),
+            frame_memory=frame_memory,
+        )
+        self.pipeline.start()
+        self.timer.timeout.connect(self.handle_close)
+        self.timer.setSingleShot(True)
+        self.timer.start(ORGANIZATION_TIMEOUT_MS)
+
+    def record_organization_pattern(self, screen_idx: int, pattern):
+        if self.organization_feedback:
+            redrawn = screen_idx in self.organization_feedback.patterns
+            # everything up to the cursor was fetched before the pattern changed
+            since = self.image_queue.cursor + 1 if self.image_queue else None
+            self.organization_feedback.pattern_applied(screen_idx, pattern, since)
+            if redrawn:
+                self.report_scene_change("organizing")
+
+    def report_scene_change(self, state: str):
+        import api
+
+        try:
+            api.scene_changed(self.connection_id, state)
+        except Exception as e:
+            # only costs a "move" directive or two, not worth stopping the stage for
+            print(f"Error reporting the redrawn screens: {e}")
+
+    def organize_displays(self, name: str, markers):
+        import api
+
+        if not self.pipeline or markers is None:
+            return
+
+        feedback = self.organization_feedback
+        for screen_idx, pattern in feedback.add_frame(*markers, frame_id=api.image_seq(name)).items():
+            print(f"Screen {screen_idx} markers not detected well enough, showing {pattern}")
+            self.update_organization_pattern.emit(screen_idx, pattern)
+
+        print(f"Considered {feedback.frame_count} images ({name}: {len(markers[0])} markers)")
+        if feedback.complete():
+            print("Every screen found in one image")
+            self.timer.stop()
+            self.handle_close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Display Organizer")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print import and init timings once the QR code is visible",
+    )
+    args, qt_args = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + qt_args
+    startup_profile.enabled = args.profile_startup
+
     app = App()
     app.start()
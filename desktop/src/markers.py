@@ -1,24 +1,33 @@
+from functools import lru_cache
 from itertools import product
-import cv2
 import numpy as np
-import qrcode
-from constants import ARUCO_TAG_DICTIONARY, CHESSBOARD, QR_CODE_PREFIX
+from constants import ARUCO_TAG_DICTIONARY, CHESSBOARD
+from qr import qr_code_matrix
 
 
+@lru_cache(maxsize=8)
 def make_qr_code_img(connection_id: str, qr_size_px: int) -> np.ndarray:
-    qr = qrcode.QRCode(
-        error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=4
-    )
+    """Square grayscale QR code, read-only since it's cached.
 
-    qr.add_data(f"{QR_CODE_PREFIX}{connection_id}")
-    qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    qr_img = qr_img.resize((qr_size_px, qr_size_px))
-    qr_img_rgb = np.array(qr_img.convert("RGB"))
-    return qr_img_rgb
+    qr_size_px on a side, or one pixel per module when that's larger, cropping modules would make
+    the code unscannable so the caller has to scale that down itself.
+    """
+    modules = ~np.array(qr_code_matrix(connection_id), dtype=bool)  # True = light
+    # a whole number of pixels per module, what's left over is added to the white quiet zone
+    module_px = max(1, qr_size_px // len(modules))
+    qr = np.repeat(np.repeat(modules, module_px, axis=0), module_px, axis=1).astype(np.uint8) * 255
+
+    size = max(qr_size_px, len(qr))
+    img = np.full((size, size), 255, dtype=np.uint8)
+    offset = (size - len(qr)) // 2
+    img[offset : offset + len(qr), offset : offset + len(qr)] = qr
+    img.flags.writeable = False
+    return img
 
 
 def make_chessboard_img(chessboard_width_px: int) -> np.ndarray:
+    import cv2
+
     rows = CHESSBOARD[0] + 1
     cols = CHESSBOARD[1] + 1
 
@@ -47,6 +56,8 @@ def make_chessboard_img(chessboard_width_px: int) -> np.ndarray:
 
 
 def make_aruco_marker_img(marker_id: int, marker_size_px: int) -> np.ndarray:
+    import cv2
+
     dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_TAG_DICTIONARY)
     marker_image = cv2.aruco.generateImageMarker(dictionary, marker_id, marker_size_px)
     marker_image_rgb = cv2.cvtColor(marker_image, cv2.COLOR_GRAY2RGB)
@@ -0,0 +1,122 @@
+# Organization stage feedback loop: markers detected in the photos streaming in from the phone
+# decide, per screen, whether its pattern has to change.
+#
+# A screen whose markers keep going undetected (usually because it is far from the camera) gets
+# larger markers, and once 3x3 markers of that size no longer fit, only the four corner markers
+# at an even larger size. Only that screen's window is redrawn (OrganizationScreen.set_pattern),
+# the others keep their pattern and their detections keep counting. Marker ids never change with
+# the pattern, the 2x2 pattern uses the corner ids of the 3x3 one, so rectify's screen corner ids
+# (SCREEN_CORNER_CELLS) are the same for both.
+#
+# The stage is complete once a single photo shows the corner markers of every screen, which is
+# what rectifying the whole layout from one image needs.
+from dataclasses import dataclass
+from typing import Callable, Optional
+import numpy as np
+from constants import ARUCO_MARKER_SIZE
+from detections import RING_CAPACITY, DetectionRing
+from undistort import CameraIntrinsics
+
+MARKERS_PER_SCREEN = 9  # ids screen_idx * 9 + cell, cells numbered row by row in the 3x3 grid
+SCREEN_CORNER_CELLS = (0, 2, 8, 6)  # tl, tr, br, bl
+MIN_FRAMES = 2  # frames showing a pattern before judging it
+GOOD_DETECTION_RATE = 0.75  # of the pattern's markers, averaged over those frames
+MARKER_GROWTH = 1.5
+
+
+@dataclass(frozen=True)
+class ScreenPattern:
+    marker_size: float = ARUCO_MARKER_SIZE  # mm
+    grid: int = 3  # 3 => 3x3 markers, 2 => only the four corners of the 3x3 grid
+
+    @property
+    def cells(self) -> tuple[int, ...]:
+        return tuple(range(MARKERS_PER_SCREEN)) if self.grid == 3 else (0, 2, 6, 8)
+
+    def marker_ids(self, screen_idx: int) -> np.ndarray:
+        return screen_idx * MARKERS_PER_SCREEN + np.array(self.cells)
+
+    def grown(self) -> "ScreenPattern":
+        # the screen fits it to its size, see fit_pattern
+        return ScreenPattern(self.marker_size * MARKER_GROWTH, self.grid)
+
+
+def fit_pattern(pattern: ScreenPattern, max_marker_size: Callable[[int], float]) -> ScreenPattern:
+    """Switches to the corner markers when 3x3 markers of that size don't fit, then clamps the size."""
+    grid = pattern.grid
+    if grid == 3 and pattern.marker_size > max_marker_size(3):
+        grid = 2
+    return ScreenPattern(min(pattern.marker_size, max_marker_size(grid)), grid)
+
+
+def screen_corner_ids(screen_count: int) -> np.ndarray:
+    """(S, 4) tl, tr, br, bl marker ids of every screen, the format rectify and DetectionRing use."""
+    return np.arange(screen_count)[:, None] * MARKERS_PER_SCREEN + np.array(SCREEN_CORNER_CELLS)
+
+
+class OrganizationFeedback:
+    def __init__(self, capacity: int = RING_CAPACITY):
+        self.ring = DetectionRing(capacity)
+        self.patterns: dict[int, ScreenPattern] = {}
+        # first frame id judged against the screen's current pattern, frame ids are the image queue's
+        # sequence numbers (the order the phone uploaded them in, not the order they're processed)
+        self.since: dict[int, int] = {}
+        self.exhausted: set[int] = set()  # screens already showing the largest pattern that fits
+        self.requested: dict[int, ScreenPattern] = {}
+        self.frame_count = 0
+
+    def pattern_applied(self, screen_idx: int, pattern: ScreenPattern, since: Optional[int] = None) -> None:
+        """since: first frame id that can show the pattern, the next one not fetched yet."""
+        # a request the screen couldn't grant (clamped to what it already shows) means we're out of options
+        if self.requested.pop(screen_idx, None) is not None and pattern == self.patterns.get(screen_idx):
+            self.exhausted.add(screen_idx)
+        self.patterns[screen_idx] = pattern
+        # frames fetched, queued or in the pool were uploaded before the new pattern was on screen,
+        # counting processed frames instead would judge them against it
+        self.since[screen_idx] = self.frame_count if since is None else since
+
+    def add_frame(
+        self, ids: np.ndarray, corners: np.ndarray, frame_id: Optional[int] = None
+    ) -> dict[int, ScreenPattern]:
+        """Records a frame's detections, returns the screens whose pattern should change."""
+        self.ring.push(self.frame_count if frame_id is None else frame_id, ids, corners)
+        self.frame_count += 1
+
+        changes = {}
+        for screen_idx, pattern in self.patterns.items():
+            if screen_idx in self.exhausted or screen_idx in self.requested:
+                continue
+            frames, rate = self.detection_rate(screen_idx)
+            if frames < MIN_FRAMES or rate >= GOOD_DETECTION_RATE:
+                continue
+            changes[screen_idx] = pattern.grown()
+
+        self.requested.update(changes)
+        return changes
+
+    def detection_rate(self, screen_idx: int) -> tuple[int, float]:
+        """Frames judged against the screen's current pattern and the fraction of its markers found in them."""
+        slots = self.ring.slots()
+        recent = self.ring.frame_ids[slots] >= self.since.get(screen_idx, 0)
+        frames = int(recent.sum())
+        if not frames:
+            return 0, 0.0
+        corners = self.ring.marker_corners(self.patterns[screen_idx].marker_ids(screen_idx))
+        detected = ~np.isnan(corners[recent, :, 0, 0])
+        return frames, float(detected.mean())
+
+    def complete(self) -> bool:
+        """Whether one buffered frame shows the corner markers of every screen."""
+        if not self.patterns:
+            return False
+        quads = self.ring.screen_quads(screen_corner_ids(max(self.patterns) + 1))
+        return bool((~np.isnan(quads[..., 0, 0])).all(axis=1).any())
+
+
+# runs in the pipeline's process pool, cv2 is only imported there and on the worker
+def process_organization_frame(
+    image_bytes: bytes, intrinsics: Optional[CameraIntrinsics] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    from rectify import detect_markers_coarse_to_fine
+
+    return detect_markers_coarse_to_fine(image_bytes, intrinsics)
@@ -0,0 +1,196 @@
+# Frame pipeline used by MainWorker while images are streaming in from the phone:
+#
+#   fetch (thread) --bounded queue--> decode + detect (process pool) --> persist (thread) --> on_result
+#
+# Each stage runs concurrently so a slow download never stalls detection and vice versa.
+# Backpressure: the fetch queue is bounded and a frame holds an in-flight slot from the moment it
+# is submitted to the pool until it has been persisted, so when detection or disk falls behind
+# the fetch stage stops polling the bridge instead of piling frames up in memory. A frame also
+# holds its estimated decode and detection memory (frame_memory, see decode.py) against a memory
+# budget until then, so a burst of 48MP photos runs fewer frames at once than a burst of small
+# ones instead of pushing the desktop into swap. A frame larger than the whole budget still runs,
+# alone.
+#
+# Decode and detect run in the same pool task on purpose, handing a decoded frame between two
+# processes would mean pickling the full bitmap. The pool is normally the app's shared vision
+# service (vision.py), cancelling a pipeline then only cancels its own frames that haven't started.
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+Frame = tuple[str, bytes]  # (file name, original encoded bytes)
+
+# bytes, override with FRAME_MEMORY_BUDGET_MB
+DEFAULT_MEMORY_BUDGET = int(float(os.getenv("FRAME_MEMORY_BUDGET_MB", "1024")) * 2**20)
+
+
+class MemoryBudget:
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int, timeout: Optional[float] = None) -> bool:
+        with self._condition:
+            # an empty budget always admits, otherwise a frame over budget would wait forever
+            if not self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.budget, timeout):
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+class FramePipeline:
+    def __init__(
+        self,
+        fetch: Callable[[], list[Frame]],
+        process: Callable[[bytes], Any],
+        persist: Callable[[str, bytes, Any], None],
+        on_result: Callable[[str, Any], None],
+        executor: Optional[Executor] = None,
+        poll_interval: float = 0.5,
+        max_queued: int = 8,
+        max_in_flight: Optional[int] = None,
+        frame_memory: Optional[Callable[[bytes], int]] = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    ):
+        self._fetch = fetch
+        self._process = process
+        self._persist = persist
+        self._on_result = on_result
+        self._poll_interval = poll_interval
+
+        self._owns_executor = executor is None
+        if executor is None:
+            # leave a core for the Qt UI thread and the I/O stages
+            executor = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1))
+        self._executor = executor
+
+        if max_in_flight is None:
+            max_in_flight = 2 * max(1, (os.cpu_count() or 2) - 1)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._frame_memory = frame_memory or (lambda data: 0)
+        self._memory = MemoryBudget(memory_budget)
+        self._fetched: queue.Queue[Frame] = queue.Queue(maxsize=max_queued)
+        self._processed: queue.Queue[tuple[str, bytes, int, Future]] = queue.Queue()
+        self._pending: set[Future] = set()
+        self._pending_lock = threading.Lock()
+
+        self._cancelled = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._fetch_stage, name="pipeline-fetch", daemon=True),
+            threading.Thread(target=self._submit_stage, name="pipeline-submit", daemon=True),
+            threading.Thread(target=self._persist_stage, name="pipeline-persist", daemon=True),
+        ]
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def cancel(self, wait: bool = False) -> None:
+        """Stop all stages, frames that are still queued or in the pool are dropped."""
+        self._cancelled.set()
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            with self._pending_lock:
+                pending = list(self._pending)
+            for future in pending:
+                future.cancel()
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def _fetch_stage(self) -> None:
+        while not self._cancelled.is_set():
+            try:
+                frames = self._fetch()
+            except Exception as e:
+                print(f"Error fetching images: {e}")
+                frames = []
+
+            for frame in frames:
+                # blocks while downstream is full, that's the backpressure
+                while not self._cancelled.is_set():
+                    try:
+                        self._fetched.put(frame, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+            if not frames:
+                self._cancelled.wait(self._poll_interval)
+
+    def _submit_stage(self) -> None:
+        while not self._cancelled.is_set():
+            try:
+                name, data = self._fetched.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            while not self._in_flight.acquire(timeout=0.1):
+                if self._cancelled.is_set():
+                    return
+
+            memory = self._frame_memory(data)
+            while not self._memory.acquire(memory, timeout=0.1):
+                if self._cancelled.is_set():
+                    self._in_flight.release()
+                    return
+
+            try:
+                future = self._executor.submit(self._process, data)
+            except RuntimeError:
+                # executor was shut down by cancel()
+                self._memory.release(memory)
+                self._in_flight.release()
+                return
+
+            with self._pending_lock:
+                self._pending.add(future)
+            future.add_done_callback(
+                lambda f, name=name, data=data, memory=memory: self._done(name, data, memory, f)
+            )
+
+    def _done(self, name: str, data: bytes, memory: int, future: Future) -> None:
+        with self._pending_lock:
+            self._pending.discard(future)
+        self._processed.put((name, data, memory, future))
+
+    def _persist_stage(self) -> None:
+        while not self._cancelled.is_set():
+            try:
+                name, data, memory, future = self._processed.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                if future.cancelled():
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error processing {name}: {e}")
+                    continue
+
+                try:
+                    self._persist(name, data, result)
+                except Exception as e:
+                    print(f"Error persisting {name}: {e}")
+
+                if not self._cancelled.is_set():
+                    self._on_result(name, result)
+            finally:
+                self._memory.release(memory)
+                self._in_flight.release()
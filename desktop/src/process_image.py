@@ -1,29 +1,35 @@
 import cv2
-from cv2.typing import MatLike
 import numpy as np
 import json
 import os
-
-def process_image(image_path: str, screen_info: dict):
+import sys
+from typing import Optional
+from detections import marker_table
+from organization import screen_corner_ids
+from rectify import detect_markers
+from undistort import CameraIntrinsics, undistort_points
+
+def process_image(image_path: str, screen_info: dict, intrinsics: Optional[CameraIntrinsics] = None):
     img = cv2.imread(image_path)
     vis_img = img.copy()
     img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
-    aru_params = cv2.aruco.DetectorParameters()
-    detector = cv2.aruco.ArucoDetector(aruco_dict, aru_params)
-    corners, ids, rejected = detector.detectMarkers(img_gray)
-
-    print(corners)
+    # drawn with the raw corners, the undistorted ones don't line up with the photo
+    ids, raw_corners = detect_markers(img_gray)
+    print(raw_corners)
 
-    vis_img = cv2.aruco.drawDetectedMarkers(vis_img, corners, ids)
+    vis_img = cv2.aruco.drawDetectedMarkers(vis_img, list(raw_corners[:, None]), ids[:, None])
     cv2.imwrite("detected_markers.jpg", vis_img)
 
-    if ids is None or len(ids) == 0:
+    if len(ids) == 0:
         print("No ArUco markers detected")
         return None
 
-    screen_corners = [get_corners_for_screen(i, corners, ids) for i in range(len(screen_info))]
+    corners = raw_corners
+    if intrinsics is not None:
+        corners = undistort_points(raw_corners, intrinsics, (img_gray.shape[1], img_gray.shape[0]))
+
+    screen_corners = get_corners_for_screens(len(screen_info), ids, corners)
 
     return None
 
@@ -31,16 +37,11 @@ def process_image(image_path: str, screen_info: dict):
 
 
 
-def get_corners_for_screen(screen_idx, corners, ids):
-    corner_indices = [screen_idx + i for i in range(4)]
-    screen_corners = []
-    for idx in corner_indices:
-        corner_idx = np.where(ids == idx)[0][0]
-        if corner_idx is None:
-            print(f"Warning: corner {idx} not found for screen {screen_idx}")
-            return None
-
-        screen_corners.append(corners[corner_idx])
+def get_corners_for_screens(screen_count, ids, corners):
+    """(S, 4 markers, 4 corners, 2) tl, tr, br, bl marker corners of every screen, NaN where not found."""
+    screen_corners = marker_table(ids, corners)[screen_corner_ids(screen_count)]
+    for screen_idx in np.flatnonzero(np.isnan(screen_corners).any(axis=(1, 2, 3))):
+        print(f"Warning: corners not found for screen {screen_idx}")
 
     return screen_corners
 
@@ -65,4 +66,6 @@ def calculate_scaling_and_offsets(screen_corners, screen_info):
 
 
 if __name__ == "__main__":
-    process_image("./test_image.jpg", dict({0: {}, 1: {}}))
+    # intrinsics saved by the calibration stage, e.g. calibration/<connection id>
+    intrinsics = CameraIntrinsics.load(sys.argv[1]) if len(sys.argv) > 1 else None
+    process_image("./test_image.jpg", dict({0: {}, 1: {}}), intrinsics)
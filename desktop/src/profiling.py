@@ -0,0 +1,43 @@
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, TextIO
+
+
+class StartupProfile:
+    """Records how long imports and initialization take relative to launch.
+
+    Timings are always recorded (it's just a perf_counter call), the report is only printed
+    when the app is started with --profile-startup.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.launched_at = time.perf_counter()
+        self.entries: list[tuple[str, str, float, float]] = []  # (kind, name, start, duration)
+        self.marks: dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, kind: str, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.entries.append((kind, name, start - self.launched_at, end - start))
+
+    def mark(self, name: str) -> None:
+        # only the first occurrence counts, e.g. the first time the QR code is visible
+        self.marks.setdefault(name, time.perf_counter() - self.launched_at)
+
+    def report(self, out: TextIO = sys.stderr) -> None:
+        print("Startup profile (ms since launch)", file=out)
+        print(f"  {'kind':<8} {'name':<32} {'start':>9} {'took':>9}", file=out)
+        for kind, name, start, duration in sorted(self.entries, key=lambda e: e[2]):
+            print(f"  {kind:<8} {name:<32} {start * 1000:>9.1f} {duration * 1000:>9.1f}", file=out)
+        for name, at in sorted(self.marks.items(), key=lambda m: m[1]):
+            print(f"  {'mark':<8} {name:<32} {at * 1000:>9.1f}", file=out)
+        out.flush()
+
+
+startup_profile = StartupProfile()
@@ -0,0 +1,23 @@
+# QR code module matrix of a connection, shared by the Qt QR screen (markers.make_qr_code_img)
+# and the terminal (cli.py).
+#
+# Encoding (mostly picking the mask pattern) is the slow part, ~7ms in pure Python, so the matrix
+# is made once per connection id and every rendering scales it: the window by an integer number
+# of pixels per module with numpy (no resampling, module edges stay sharp), the terminal by half
+# block characters. Only qrcode is imported here so the terminal path stays free of numpy.
+from functools import lru_cache
+import qrcode
+from constants import QR_CODE_PREFIX
+
+QR_CODE_BORDER = 4  # modules of quiet zone, the minimum the spec asks for
+
+
+@lru_cache(maxsize=8)
+def qr_code_matrix(connection_id: str) -> tuple[tuple[bool, ...], ...]:
+    """Rows of modules (True = dark) including the quiet zone."""
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=1, border=QR_CODE_BORDER
+    )
+    qr.add_data(f"{QR_CODE_PREFIX}{connection_id}")
+    qr.make(fit=True)
+    return tuple(tuple(row) for row in qr.get_matrix())
@@ -0,0 +1,232 @@
+# Pairing QR code detector.
+#
+# Strategies are tried from cheapest to most expensive and the first one that decodes a valid
+# QR_CODE_PREFIX + UUID wins:
+#   1. the region the code was found in on the previous frame
+#   2. grayscale at each level of a downscaled pyramid (smallest first)
+#   3. adaptive threshold binary at each pyramid level, for uneven lighting / screen glare
+# A screen-sized QR code is usually decodable at the smallest level, so the common case costs
+# one detectAndDecode on a ~800px image instead of three detectAndDecodeMulti on the full photo.
+#
+# Benchmark on a directory of screen photos: python3 ./desktop/src/qr_detect.py <dir>
+# Without real photos, --synthetic N first fills <dir> with N renders of the pairing QR code on a
+# screen in a 12MP photo (perspective, uneven lighting, sensor noise, JPEG).
+import argparse
+import glob
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+import cv2
+import numpy as np
+from constants import QR_CODE_PREFIX
+
+# keep in sync with mobile/constants/ConnectionIDRegex.ts
+CONNECTION_ID_REGEX = re.compile(
+    f"^{QR_CODE_PREFIX}([0-9a-f]{{8}}-[0-9a-f]{{4}}-4[0-9a-f]{{3}}-[89ab][0-9a-f]{{3}}-[0-9a-f]{{12}})$"
+)
+PYRAMID_MAX_EDGES = (800, 1600)  # px, full resolution is always the last level
+ROI_MARGIN = 0.5  # grow the previous frame's QR box by this fraction on each side
+ADAPTIVE_THRESHOLD_BLOCK_SIZE = 51  # at full resolution, scaled down with the pyramid
+ADAPTIVE_THRESHOLD_C = 9
+
+
+@dataclass
+class QRDetection:
+    connection_id: str
+    points: np.ndarray  # 4x2 corners in full resolution image coordinates
+    strategy: str
+
+
+def parse_connection_id(data: str) -> Optional[str]:
+    match = CONNECTION_ID_REGEX.match(data or "")
+    return match.group(1) if match else None
+
+
+class QRPairingDetector:
+    def __init__(self):
+        self._detector = cv2.QRCodeDetector()
+        self._roi_hint: Optional[tuple[int, int, int, int]] = None  # x0, y0, x1, y1
+        self._roi_shape: Optional[tuple[int, int]] = None  # (height, width) of the frame the hint is from
+
+    def reset(self) -> None:
+        self._roi_hint = None
+
+    def detect(self, image: np.ndarray) -> Optional[QRDetection]:
+        detection = None
+        # a hint from a frame of another size doesn't point at anything in this one
+        if self._roi_hint and self._roi_shape == image.shape[:2]:
+            detection = self._detect_roi(image, self._roi_hint)
+        if detection is None:
+            detection = self._detect_pyramid(_to_gray(image))
+
+        self._roi_hint = _roi_around(detection.points, image.shape) if detection else None
+        self._roi_shape = image.shape[:2] if detection else None
+        return detection
+
+    def _detect_roi(self, image: np.ndarray, roi: tuple[int, int, int, int]) -> Optional[QRDetection]:
+        # only the crop is converted to grayscale, not the whole photo
+        x0, y0, x1, y1 = roi
+        x0, x1 = max(0, x0), min(image.shape[1], x1)
+        y0, y1 = max(0, y0), min(image.shape[0], y1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        crop = _to_gray(image[y0:y1, x0:x1])
+        detection = self._decode_scaled(crop, PYRAMID_MAX_EDGES[0], "roi", binary=False)
+        if detection:
+            detection.points += (x0, y0)
+        return detection
+
+    def _detect_pyramid(self, gray: np.ndarray) -> Optional[QRDetection]:
+        max_edges = [edge for edge in PYRAMID_MAX_EDGES if edge < max(gray.shape)] + [max(gray.shape)]
+        for binary in (False, True):
+            for max_edge in max_edges:
+                strategy = f"{'binary' if binary else 'gray'}@{max_edge}"
+                detection = self._decode_scaled(gray, max_edge, strategy, binary)
+                if detection:
+                    return detection
+        return None
+
+    def _decode_scaled(
+        self, gray: np.ndarray, max_edge: int, strategy: str, binary: bool
+    ) -> Optional[QRDetection]:
+        scale = min(1.0, max_edge / max(gray.shape))
+        level = gray
+        if scale < 1.0:
+            level = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        if binary:
+            block_size = max(3, int(ADAPTIVE_THRESHOLD_BLOCK_SIZE * scale) | 1)
+            level = cv2.adaptiveThreshold(
+                level,
+                255,
+                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY,
+                block_size,
+                ADAPTIVE_THRESHOLD_C,
+            )
+
+        data, points, _ = self._detector.detectAndDecode(level)
+        connection_id = parse_connection_id(data)
+        if connection_id is None or points is None:
+            return None
+        return QRDetection(connection_id, points.reshape(4, 2) / scale, strategy)
+
+
+def _to_gray(image: np.ndarray) -> np.ndarray:
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def _roi_around(points: np.ndarray, shape: tuple[int, ...]) -> tuple[int, int, int, int]:
+    (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+    margin_x, margin_y = (x1 - x0) * ROI_MARGIN, (y1 - y0) * ROI_MARGIN
+    return (
+        max(0, int(x0 - margin_x)),
+        max(0, int(y0 - margin_y)),
+        min(shape[1], int(x1 + margin_x) + 1),
+        min(shape[0], int(y1 + margin_y) + 1),
+    )
+
+
+def _detect_exhaustive(image: np.ndarray) -> Optional[str]:
+    # what qrcode-test.py does, kept as the benchmark baseline
+    detector = cv2.QRCodeDetector()
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 51, 9
+    )
+    found = set()
+    for img in (image, gray, binary):
+        retval, decoded_info, _, _ = detector.detectAndDecodeMulti(img)
+        if retval:
+            found.update(decoded_info)
+    return next(filter(None, map(parse_connection_id, found)), None)
+
+
+def benchmark(paths: list[str], repeat: int = 3) -> None:
+    images = [(path, cv2.imread(path)) for path in paths]
+    images = [(path, img) for path, img in images if img is not None]
+    if not images:
+        print("No images to benchmark")
+        return
+
+    detector = QRPairingDetector()
+    totals = {"exhaustive": 0.0, "cold": 0.0, "warm": 0.0}
+    hits = {"exhaustive": 0, "cold": 0, "warm": 0}
+
+    print(f"{'image':<40} {'exhaustive ms':>14} {'cold ms':>9} {'warm ms':>9}  strategy")
+    for path, img in images:
+        timings = {}
+        for name in totals:
+            best, result = float("inf"), None
+            for _ in range(repeat):
+                if name == "cold":
+                    detector.reset()
+                elif name == "warm":
+                    # ROI hint from detecting the same image once, like a steady camera
+                    detector.reset()
+                    detector.detect(img)
+                start = time.perf_counter()
+                result = _detect_exhaustive(img) if name == "exhaustive" else detector.detect(img)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+            totals[name] += best
+            hits[name] += result is not None
+        strategy = result.strategy if result else "-"
+        print(
+            f"{path[-40:]:<40} {timings['exhaustive'] * 1000:>14.1f} "
+            f"{timings['cold'] * 1000:>9.1f} {timings['warm'] * 1000:>9.1f}  {strategy}"
+        )
+
+    print()
+    for name in totals:
+        print(
+            f"{name:<10} mean {totals[name] / len(images) * 1000:8.1f} ms  "
+            f"decoded {hits[name]}/{len(images)}"
+        )
+
+
+def make_synthetic_corpus(directory: str, count: int, seed: int = 0) -> None:
+    from markers import make_qr_code_img
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    height, width = 3000, 4000
+    for i in range(count):
+        qr_size = int(rng.integers(400, 1400))
+        qr = make_qr_code_img(str(uuid.UUID(bytes=rng.bytes(16), version=4)), qr_size)
+        # the screen around the code, then tilted and placed somewhere in the photo
+        screen = np.full((qr_size * 2, qr_size * 3), 235, dtype=np.uint8)
+        screen[qr_size // 2 : qr_size // 2 + qr_size, qr_size : 2 * qr_size] = qr
+        h, w = screen.shape
+        x, y = rng.uniform(0, width - w * 0.8), rng.uniform(0, height - h * 0.8)
+        jitter = rng.uniform(-0.08, 0.08, (4, 2)) * (w, h)
+        src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        dst = np.float32(src * 0.8 + (x, y) + jitter)
+        photo = cv2.warpPerspective(
+            screen, cv2.getPerspectiveTransform(src, dst), (width, height), borderValue=60
+        ).astype(np.float32)
+        # light falling off across the photo, plus sensor noise
+        photo *= np.linspace(rng.uniform(0.6, 1.0), rng.uniform(0.6, 1.0), width, dtype=np.float32)
+        photo += rng.normal(0, 6, photo.shape).astype(np.float32)
+        photo = cv2.cvtColor(np.clip(photo, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+        cv2.imwrite(os.path.join(directory, f"synthetic_{i:03d}.jpg"), photo, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pairing QR detector")
+    parser.add_argument("directory", help="directory of screen photos")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="first write N synthetic photos into it")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        make_synthetic_corpus(args.directory, args.synthetic)
+    benchmark(
+        sorted(
+            path
+            for ext in ("jpg", "jpeg", "png")
+            for path in glob.glob(os.path.join(args.directory, f"*.{ext}"))
+        )
+    )
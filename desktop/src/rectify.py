@@ -0,0 +1,190 @@
+# Rectification of every screen in a photo from a single marker detection pass.
+#
+# Each screen is described by the ids of its four corner markers in top-left, top-right,
+# bottom-right, bottom-left order, the outer corner of each marker spans the screen quad.
+# All warps read straight from the shared source image into preallocated (reusable) outputs,
+# scale factors come from pushing the top-left marker through each homography instead of
+# detecting markers again on the rectified images, so the cost is one detection plus one warp
+# per screen.
+#
+# Detected corners are refined to sub-pixel accuracy by the detector. Encoded photos from the phone
+# go through detect_markers_coarse_to_fine, which detects on a reduced decode of large photos and
+# only refines the found corners at full resolution (decode.py). Passing the phone's
+# intrinsics to detect_markers also undistorts them (undistort.py), for layout maths only, the
+# warps here sample the distorted photo so rectify_screens wants the raw corners.
+from dataclasses import dataclass, field
+from typing import Optional, Sequence
+import cv2
+import numpy as np
+from constants import ARUCO_TAG_DICTIONARY
+from decode import decode_image, jpeg_size, reduction_for, to_full_resolution
+from detections import from_detector, marker_table
+from undistort import CameraIntrinsics, undistort_points
+
+MARKER_PADDING_RATIO = 0.1  # of the marker edge, extra border kept around each screen quad
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+MIN_SUBPIX_WINDOW = 3  # px, half size of the full resolution refinement window
+
+# outward direction of the padding for the tl, tr, br, bl corners
+_PADDING_SIGNS = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float32)
+
+_detector: Optional[cv2.aruco.ArucoDetector] = None
+
+
+def get_detector() -> cv2.aruco.ArucoDetector:
+    global _detector
+    if _detector is None:
+        dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_TAG_DICTIONARY)
+        parameters = cv2.aruco.DetectorParameters()
+        parameters.cornerRefinementMethod = cv2.aruco.CORNER_REFINE_SUBPIX
+        _detector = cv2.aruco.ArucoDetector(dictionary, parameters)
+    return _detector
+
+
+def detect_markers(
+    image: np.ndarray, intrinsics: Optional[CameraIntrinsics] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """(n,) marker ids and (n, 4, 2) corners, see detections.py, undistorted when intrinsics are given."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    corners, ids, _ = get_detector().detectMarkers(gray)
+    ids, corners = from_detector(corners, ids)
+    if intrinsics is not None:
+        corners = undistort_points(corners, intrinsics, (gray.shape[1], gray.shape[0]))
+    return ids, corners
+
+
+def detect_markers_coarse_to_fine(
+    image_bytes: bytes, intrinsics: Optional[CameraIntrinsics] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """detect_markers on an encoded photo, with corners in full resolution pixels."""
+    size = jpeg_size(image_bytes)
+    reduction = reduction_for(size)
+    coarse = decode_image(image_bytes, reduction)
+    if reduction == 1:
+        return detect_markers(coarse, intrinsics)
+
+    ids, corners = detect_markers(coarse)
+    del coarse
+    if len(ids) == 0:
+        return ids, corners
+    # the decoded size, not the JPEG header's: imdecode applies the EXIF orientation
+    gray = decode_image(image_bytes)
+    corners = refine_corners(gray, to_full_resolution(corners, reduction), reduction)
+    if intrinsics is not None:
+        corners = undistort_points(corners, intrinsics, (gray.shape[1], gray.shape[0]))
+    return ids, corners
+
+
+def refine_corners(gray: np.ndarray, corners: np.ndarray, reduction: int) -> np.ndarray:
+    """Refines (n, 4, 2) corners scaled up from a 1/reduction detection, in windows around each corner."""
+    # a window spanning a couple of coarse pixels, but well inside the smallest marker's cells
+    edges = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+    window = int(np.clip(edges.min() / 12, MIN_SUBPIX_WINDOW, 2 * reduction))
+    refined = cv2.cornerSubPix(
+        gray, corners.reshape(-1, 1, 2).astype(np.float32), (window, window), (-1, -1), SUBPIX_CRITERIA
+    )
+    return refined.reshape(corners.shape)
+
+
+@dataclass
+class RectifiedScreens:
+    # one entry per requested screen, None / NaN when one of its markers wasn't detected
+    images: list[Optional[np.ndarray]]
+    previews: list[Optional[np.ndarray]]
+    homographies: np.ndarray  # (N, 3, 3) source => rectified
+    offsets: np.ndarray  # (N, 2) top-left of the rectified screen in source pixels
+    sizes: np.ndarray  # (N, 2) width, height of the rectified screen
+    marker_diagonals: np.ndarray  # (N,) mean diagonal of the top-left marker after rectification
+    found: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        self.found = ~np.isnan(self.marker_diagonals)
+
+    @property
+    def scale_factors(self) -> np.ndarray:
+        """Marker size of each screen relative to the first screen, like marker_align_test did."""
+        return self.marker_diagonals / self.marker_diagonals[0]
+
+
+def screen_quads(
+    markers: tuple[np.ndarray, np.ndarray], screens: Sequence[Sequence[int]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Padded (N, 4, 2) screen quads and the (N, 4, 2) top-left marker of each, NaN if not found."""
+    table = marker_table(*markers)
+    screen_markers = table[np.asarray(screens)]  # (N, 4 markers, 4 corners, 2)
+    # outer corner k of the marker in position k, a screen missing any marker is NaN everywhere
+    k = np.arange(4)
+    quads = screen_markers[:, k, k]
+    missing = np.isnan(quads).any(axis=(1, 2))
+    quads[missing] = np.nan
+    top_left_markers = screen_markers[:, 0]
+    top_left_markers[missing] = np.nan
+
+    marker_edge = np.linalg.norm(top_left_markers[:, 0] - top_left_markers[:, 1], axis=1)
+    padding = np.floor(marker_edge * MARKER_PADDING_RATIO)
+    return quads + padding[:, None, None] * _PADDING_SIGNS, top_left_markers
+
+
+def rectify_screens(
+    image: np.ndarray,
+    screens: Sequence[Sequence[int]],
+    markers: Optional[tuple[np.ndarray, np.ndarray]] = None,
+    outputs: Optional[list[Optional[np.ndarray]]] = None,
+    preview_scale: Optional[float] = None,
+    full_resolution: bool = True,
+) -> RectifiedScreens:
+    """Rectifies every screen in image.
+
+    markers: reuse an existing detection pass instead of detecting again.
+    outputs: buffers from a previous call, reused when the screen size didn't change.
+    preview_scale: also warp a lower resolution preview, directly from the source image.
+    full_resolution: set to False to only produce previews.
+    """
+    if markers is None:
+        markers = detect_markers(image)
+
+    n = len(screens)
+    quads, top_left_markers = screen_quads(markers, screens)
+    found = ~np.isnan(quads).any(axis=(1, 2))
+    offsets = np.full((n, 2), np.nan)
+    sizes = np.full((n, 2), np.nan)
+    offsets[found] = np.floor(quads[found].min(axis=1))
+    sizes[found] = np.floor(quads[found].max(axis=1)) - offsets[found]
+
+    homographies = np.full((n, 3, 3), np.nan)
+    marker_diagonals = np.full(n, np.nan)
+    images: list[Optional[np.ndarray]] = [None] * n
+    previews: list[Optional[np.ndarray]] = [None] * n
+
+    for i in np.flatnonzero(found):
+        width, height = int(sizes[i, 0]), int(sizes[i, 1])
+        rect = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float32)
+        homography = cv2.getPerspectiveTransform(quads[i], rect)
+        homographies[i] = homography
+
+        rectified_marker = cv2.perspectiveTransform(top_left_markers[i][None], homography)[0]
+        marker_diagonals[i] = (
+            np.linalg.norm(rectified_marker[0] - rectified_marker[2])
+            + np.linalg.norm(rectified_marker[1] - rectified_marker[3])
+        ) / 2.0
+
+        if full_resolution:
+            images[i] = _warp_into(
+                image, homography, (width, height), outputs[i] if outputs and i < len(outputs) else None
+            )
+        if preview_scale:
+            scale = np.diag([preview_scale, preview_scale, 1.0])
+            preview_size = (max(1, int(width * preview_scale)), max(1, int(height * preview_scale)))
+            previews[i] = _warp_into(image, scale @ homography, preview_size, None)
+
+    return RectifiedScreens(images, previews, homographies, offsets, sizes, marker_diagonals)
+
+
+def _warp_into(
+    image: np.ndarray, homography: np.ndarray, size: tuple[int, int], out: Optional[np.ndarray]
+) -> np.ndarray:
+    shape = (size[1], size[0]) + image.shape[2:]
+    if out is None or out.shape != shape or out.dtype != image.dtype:
+        out = np.empty(shape, dtype=image.dtype)
+    cv2.warpPerspective(image, homography, size, dst=out)
+    return out
@@ -1,16 +1,18 @@
 # SCREENS:
-# - QR code screen: main screen (window or fullscreen and CLI)
+# - QR code screen: main screen (window or fullscreen, CLI version lives in cli.py)
 #   - 5 or 10cm QR code
 # - Calibration screen: all screens
 #   - large 6x9 fullscreen openCV chessboard with 1-2cm padding around the edges
+#   - moved and resized to where the photos so far lack corners, see calibration_planner.py
 # - Organization screen: all screens
 #   - 5cm aruco tags, 9 total, 1cm edge padding
-# - Success screen
+#   - grown (or cut down to the 4 corners) per screen when the phone can't detect them, see organization.py
+# - Success screen (CLI version lives in cli.py)
 #   - button to test out, apply, or cancel reorganization
 #   - button to leave review with comment optional
 #   - button to buy me a coffee
 #   - show calculated display positions and resolutions
-from itertools import product
+from typing import Optional
 from PyQt6.QtWidgets import QApplication, QWidget, QVBoxLayout, QSizePolicy, QLabel
 from PyQt6.QtGui import QPixmap, QImage, QScreen
 from PyQt6.QtCore import Qt, pyqtSignal, QObject
@@ -18,23 +20,18 @@ import numpy as np
 from constants import (
     ARUCO_MARKER_PADDING,
     QR_CODE_SIZE,
-    CHESSBOARD,
-    CHESSBOARD_SIZE,
-    ARUCO_MARKER_SIZE,
+    CHESSBOARD_PADDING,
 )
+from calibration_planner import BoardPlacement, board_aspect
+from organization import MARKERS_PER_SCREEN, ScreenPattern, fit_pattern
 from markers import make_qr_code_img, make_chessboard_img, make_aruco_marker_img
 
 
-# XXX: probably should provide this since i can't code sign apps right now for distribution
-def qr_code_cli(connection_id: str):
-    pass
-
-
 class QRCodeScreen(QWidget):
     screen_close_requested = pyqtSignal()
 
     def __init__(
-        self, app: QApplication, connection_id: str, fullscreen=False
+        self, app: QApplication, connection_id: Optional[str], fullscreen=False
     ):
         super().__init__()
         screen = app.primaryScreen()
@@ -50,6 +47,7 @@ class QRCodeScreen(QWidget):
         # pixels per inch => pixels per mm
         ppmm = screen.physicalDotsPerInch() / 25.4
         qr_code_size_px = int(QR_CODE_SIZE * ppmm)
+        self._qr_code_size_px = qr_code_size_px
 
         self.setFixedSize(qr_code_size_px, qr_code_size_px)
 
@@ -62,24 +60,41 @@ class QRCodeScreen(QWidget):
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
 
-        # get image into Qt format
+        # the window can be shown before the connection id is known, see set_connection_id
+        self._label = QLabel("Connecting...")
+        self._label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self._label.setStyleSheet("background-color: white; color: black;")
+        layout.addWidget(self._label)
+
+        if connection_id:
+            self.set_connection_id(connection_id)
+
+    def set_connection_id(self, connection_id: str) -> None:
+        qr_code_size_px = self._qr_code_size_px
+
+        # get image into Qt format, modules are whole pixels so no smoothing anywhere
         qr_code_img = make_qr_code_img(connection_id, qr_code_size_px)
-        bytes_per_line = 3 * qr_code_size_px
+        img_size_px = qr_code_img.shape[0]
         pixmap = QPixmap.fromImage(
             QImage(
                 qr_code_img.data,
+                img_size_px,
+                img_size_px,
+                img_size_px,
+                QImage.Format.Format_Grayscale8,
+            )
+        )
+        if img_size_px > qr_code_size_px:
+            # fewer pixels than modules, only a whole-code resample keeps it scannable
+            pixmap = pixmap.scaled(
                 qr_code_size_px,
                 qr_code_size_px,
-                bytes_per_line,
-                QImage.Format.Format_RGB888,
+                Qt.AspectRatioMode.KeepAspectRatio,
+                Qt.TransformationMode.SmoothTransformation,
             )
-        )
 
         # display image
-        label = QLabel()
-        label.setPixmap(pixmap)
-        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        layout.addWidget(label)
+        self._label.setPixmap(pixmap)
 
     def keyPressEvent(self, a0):
         super().keyPressEvent(a0)
@@ -89,6 +104,8 @@ class QRCodeScreen(QWidget):
 
 class CalibrationScreen(QWidget):
     screen_close_requested = pyqtSignal()
+    # BoardPlacement fitted to the window, window (width, height) in mm
+    board_placed = pyqtSignal(object, object)
 
     def __init__(self, app: QApplication):
         super().__init__()
@@ -113,28 +130,59 @@ class CalibrationScreen(QWidget):
         self.setGeometry(window_geometry)
 
         # pixels per inch => pixels per mm
-        ppmm = screen.physicalDotsPerInch() / 25.4
-        chessboard_width_px = int(CHESSBOARD_SIZE * ppmm)
-        chessboard_height_px = int(
-            CHESSBOARD_SIZE * (CHESSBOARD[0] + 1) / (CHESSBOARD[1] + 1) * ppmm
-        )
+        self._ppmm = screen.physicalDotsPerInch() / 25.4
+        # background img, redrawn in place when the planner moves the board
+        self._img = np.empty((window_height, window_width, 3), dtype=np.uint8)
+        self.window_size_mm = (window_width / self._ppmm, window_height / self._ppmm)
 
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
 
-        # background img
-        img = np.ones((window_height, window_width, 3), dtype=np.uint8) * 128
-
-        insert = (
-            (window_height - chessboard_height_px) // 2,
-            (window_height - chessboard_height_px) // 2 + chessboard_height_px - 1,
-            (window_width - chessboard_width_px) // 2,
-            (window_width - chessboard_width_px) // 2 + chessboard_width_px,
+        self._label = QLabel()
+        self._label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(self._label)
+
+        self.placement = self._fit(BoardPlacement())
+        self._render_board()
+
+    def set_board(self, placement: BoardPlacement) -> None:
+        placement = self._fit(placement)
+        if placement != self.placement:
+            self.placement = placement
+            self._render_board()
+        self.board_placed.emit(placement, self.window_size_mm)
+
+    def _fit(self, placement: BoardPlacement) -> BoardPlacement:
+        # largest size that fits inside the padding, then keep the whole board on screen
+        width_mm, height_mm = self.window_size_mm
+        aspect = board_aspect()
+        size = min(
+            placement.size,
+            width_mm - 2 * CHESSBOARD_PADDING,
+            (height_mm - 2 * CHESSBOARD_PADDING) / aspect,
+        )
+        half_x = (size / 2 + CHESSBOARD_PADDING) / width_mm
+        half_y = (size * aspect / 2 + CHESSBOARD_PADDING) / height_mm
+        center = (
+            min(max(placement.center[0], half_x), 1 - half_x),
+            min(max(placement.center[1], half_y), 1 - half_y),
         )
+        return BoardPlacement(center, size)
+
+    def _render_board(self) -> None:
+        img = self._img
+        window_height, window_width = img.shape[:2]
+        img.fill(128)
+
+        chessboard_img = make_chessboard_img(int(self.placement.size * self._ppmm))
+        chessboard_height_px, chessboard_width_px = chessboard_img.shape[:2]
+        top = int(self.placement.center[1] * window_height - chessboard_height_px / 2)
+        left = int(self.placement.center[0] * window_width - chessboard_width_px / 2)
+        top = min(max(top, 0), window_height - chessboard_height_px)
+        left = min(max(left, 0), window_width - chessboard_width_px)
+        img[top : top + chessboard_height_px, left : left + chessboard_width_px] = chessboard_img
 
         # get image into Qt format
-        chessboard_img = make_chessboard_img(chessboard_width_px)
-        img[insert[0] : insert[1], insert[2] : insert[3]] = chessboard_img
         bytes_per_line = 3 * window_width
         pixmap = QPixmap.fromImage(
             QImage(
@@ -147,10 +195,7 @@ class CalibrationScreen(QWidget):
         )
 
         # display image
-        label = QLabel()
-        label.setPixmap(pixmap)
-        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        layout.addWidget(label)
+        self._label.setPixmap(pixmap)
 
     def keyPressEvent(self, a0):
         super().keyPressEvent(a0)
@@ -160,6 +205,8 @@ class CalibrationScreen(QWidget):
 
 class OrganizationScreen(QObject):
     screen_close_requested = pyqtSignal()
+    # screen index, the ScreenPattern it shows now (fitted to the screen, may differ from the request)
+    pattern_applied = pyqtSignal(int, object)
 
     def __init__(
         self,
@@ -170,6 +217,9 @@ class OrganizationScreen(QObject):
             self._make_organization_window(i, screen)
             for i, screen in enumerate(app.screens())
         ]
+        self.patterns = [ScreenPattern() for _ in self._windows]
+        for i in range(len(self._windows)):
+            self._render_pattern(i)
 
     def _make_organization_window(self, screen_idx: int, screen: QScreen):
         window = QWidget()
@@ -191,24 +241,60 @@ class OrganizationScreen(QObject):
         window_geometry.setTop(top_inset)
         window.setGeometry(window_geometry)
 
-        # pixels per inch => pixels per mm
-        ppmm = screen.physicalDotsPerInch() / 25.4
-        marker_size_px = int(ARUCO_MARKER_SIZE * ppmm)
-        marker_padding_px = int(ARUCO_MARKER_PADDING * ppmm)
-
         layout = QVBoxLayout(window)
         layout.setContentsMargins(0, 0, 0, 0)
 
+        label = QLabel()
+        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(label)
+
+        # kept per window so a pattern change only redraws this window's image
+        window.label = label
+        window.img = np.empty((window_height, window_width, 3), dtype=np.uint8)
+        # pixels per inch => pixels per mm
+        window.ppmm = screen.physicalDotsPerInch() / 25.4
+
+        window.keyPressEvent = lambda a0: (
+            self.screen_close_requested.emit() if a0 and a0.key() == Qt.Key.Key_Escape else None
+        )
+
+        return window
+
+    def _max_marker_size(self, screen_idx: int, grid: int) -> float:
+        # mm, grid markers plus a quarter marker gap between them across the shorter side
+        window = self._windows[screen_idx]
+        window_height, window_width = window.img.shape[:2]
+        marker_padding_px = int(ARUCO_MARKER_PADDING * window.ppmm)
+        available_px = min(window_width, window_height) - 2 * marker_padding_px
+        return available_px / (grid + (grid - 1) / 4) / window.ppmm
+
+    def set_pattern(self, screen_idx: int, pattern: ScreenPattern) -> None:
+        pattern = fit_pattern(pattern, lambda grid: self._max_marker_size(screen_idx, grid))
+        if pattern != self.patterns[screen_idx]:
+            self.patterns[screen_idx] = pattern
+            self._render_pattern(screen_idx)
+        self.pattern_applied.emit(screen_idx, pattern)
+
+    def _render_pattern(self, screen_idx: int) -> None:
+        window = self._windows[screen_idx]
+        pattern = self.patterns[screen_idx]
+        img = window.img
+        window_height, window_width = img.shape[:2]
+
+        marker_size_px = int(pattern.marker_size * window.ppmm)
+        marker_padding_px = int(ARUCO_MARKER_PADDING * window.ppmm)
+
         # background img
-        img = np.ones((window_height, window_width, 3), dtype=np.uint8) * 128
+        img.fill(128)
 
         effective_width = window_width - 2 * marker_padding_px - marker_size_px
         effective_height = window_height - 2 * marker_padding_px - marker_size_px
-        for i, j in product(range(3), range(3)):
+        for cell in pattern.cells:
+            i, j = divmod(cell, 3)
             x = int(j * effective_width / 2) + marker_padding_px
             y = int(i * effective_height / 2) + marker_padding_px
 
-            marker_id = screen_idx * 9 + i * 3 + j
+            marker_id = screen_idx * MARKERS_PER_SCREEN + cell
             marker_img = make_aruco_marker_img(marker_id, marker_size_px)
             img[y : y + marker_size_px, x : x + marker_size_px] = marker_img
 
@@ -225,16 +311,7 @@ class OrganizationScreen(QObject):
         )
 
         # display image
-        label = QLabel()
-        label.setPixmap(pixmap)
-        label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        layout.addWidget(label)
-
-        window.keyPressEvent = lambda a0: (
-            self.screen_close_requested.emit() if a0 and a0.key() == Qt.Key.Key_Escape else None
-        )
-
-        return window
+        window.label.setPixmap(pixmap)
 
     def show(self):
         for window in self._windows:
@@ -245,10 +322,5 @@ class OrganizationScreen(QObject):
             window.close()
 
 
-# XXX: probably should provide this since i can't code sign apps right now for distribution
-def finish_screen_cli():
-    pass
-
-
 def finish_screen(app: QApplication):
     pass
@@ -0,0 +1,103 @@
+# Lens undistortion of detected points with the phone's intrinsics from the calibration stage.
+#
+# Only the detected points are undistorted (cv2.undistortPoints, re-projected through the same
+# camera matrix so they stay in pixels), never whole images: a few hundred marker corners cost
+# microseconds where remapping a 12MP photo costs tens of milliseconds. Photos don't always come
+# in at the resolution the calibration ran at, so the camera matrix scaled to each resolution is
+# cached per device and resolution, in each process since the intrinsics are pickled with every
+# frame sent to the pipeline's process pool.
+#
+# Images are still warped with the raw (distorted) corners in rectify.py, the undistorted ones are
+# for layout maths that assume a pinhole camera.
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+
+INTRINSICS_FILE = "intrinsics.json"
+MAX_SCALE_MISMATCH = 0.01  # between the x and y scale of a resolution the intrinsics still fit
+
+# (device id, image size) => (calibrated camera matrix, camera matrix scaled to the image size or
+# None when the intrinsics don't fit that size)
+_camera_matrices: dict[tuple[str, tuple[int, int]], tuple[np.ndarray, Optional[np.ndarray]]] = {}
+
+
+@dataclass
+class CameraIntrinsics:
+    camera_matrix: np.ndarray  # 3x3
+    dist_coeffs: np.ndarray
+    image_size: tuple[int, int]  # (width, height) the calibration ran at
+    device_id: str = "unknown"
+
+    def camera_matrix_for(self, image_size: tuple[int, int]) -> Optional[np.ndarray]:
+        """Camera matrix for photos of another resolution (same sensor crop, same orientation).
+
+        None when the photo doesn't fit the calibration: portrait against landscape (which way it
+        was rotated isn't known, so the principal point can't be moved) or another aspect ratio
+        (stretching fx and fy apart would bend the points instead of undistorting them).
+        """
+        key = (self.device_id, tuple(image_size))
+        cached = _camera_matrices.get(key)
+        # a recalibrated device replaces its entries
+        if cached is not None and np.array_equal(cached[0], self.camera_matrix):
+            return cached[1]
+        scale_x = image_size[0] / self.image_size[0]
+        scale_y = image_size[1] / self.image_size[1]
+        camera_matrix = None
+        if abs(scale_x - scale_y) <= MAX_SCALE_MISMATCH * max(scale_x, scale_y):
+            camera_matrix = np.diag([scale_x, scale_y, 1.0]) @ self.camera_matrix
+        else:
+            print(
+                f"Intrinsics of {self.device_id} ({self.image_size[0]}x{self.image_size[1]}) don't fit "
+                f"{image_size[0]}x{image_size[1]} photos, their points aren't undistorted"
+            )
+        _camera_matrices[key] = (self.camera_matrix, camera_matrix)
+        return camera_matrix
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, INTRINSICS_FILE), "w") as f:
+            json.dump(
+                {
+                    "camera_matrix": self.camera_matrix.tolist(),
+                    "dist_coeffs": self.dist_coeffs.ravel().tolist(),
+                    "image_size": list(self.image_size),
+                    "device_id": self.device_id,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> Optional["CameraIntrinsics"]:
+        try:
+            with open(os.path.join(path, INTRINSICS_FILE)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls(
+            np.array(data["camera_matrix"], dtype=np.float64),
+            np.array(data["dist_coeffs"], dtype=np.float64),
+            tuple(data["image_size"]),
+            data.get("device_id", "unknown"),
+        )
+
+
+def undistort_points(
+    points: np.ndarray, intrinsics: CameraIntrinsics, image_size: tuple[int, int]
+) -> np.ndarray:
+    """Undistorted copy of (..., 2) pixel coordinates from a photo of image_size, still in pixels.
+
+    A plain copy when the intrinsics don't fit the photo, see CameraIntrinsics.camera_matrix_for.
+    """
+    import cv2
+
+    if points.size == 0:
+        return points.copy()
+    camera_matrix = intrinsics.camera_matrix_for(image_size)
+    if camera_matrix is None:
+        return points.copy()
+    undistorted = cv2.undistortPoints(
+        points.reshape(-1, 1, 2).astype(np.float64), camera_matrix, intrinsics.dist_coeffs, P=camera_matrix
+    )
+    return undistorted.reshape(points.shape).astype(points.dtype)
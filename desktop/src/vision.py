@@ -0,0 +1,134 @@
+# Vision worker service: one process pool for all of the app's OpenCV work, shared by every stage
+# (and FramePipeline) instead of a new pool per stage.
+#
+# - warm: each worker imports cv2 and builds the ArUco detector when it starts, so the first
+#   frame of a stage doesn't pay for it, and OpenCV's own threads are turned off, one frame per
+#   core is what uses every core during a burst without oversubscribing them
+# - shared memory handoff: bytes and numpy array arguments are copied once into a shared memory
+#   block instead of being pickled through the pool's pipe, the worker maps arrays straight out
+#   of it (read-only, don't return views of them) and bytes are copied out once
+# - submit(fn, *args) returns a concurrent.futures.Future, so it works as FramePipeline's executor,
+#   can be waited on with result() or awaited with asyncio.wrap_future
+#
+# Functions and other arguments are still pickled, keep them module level and small.
+import os
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Optional
+import numpy as np
+
+# (shared memory name, shape, dtype) of an argument, bytes are a uint8 array with shape None
+_Shared = tuple[str, Optional[tuple[int, ...]], str]
+
+_service: Optional["VisionService"] = None
+_service_lock = threading.Lock()
+
+
+def _warm_up() -> None:
+    import cv2
+    from rectify import get_detector
+
+    cv2.setNumThreads(1)
+    get_detector()
+
+
+def _run_shared(fn: Callable, args: tuple, shared: dict[int, _Shared]) -> Any:
+    blocks = []
+    try:
+        args = list(args)
+        for i, (name, shape, dtype) in shared.items():
+            block = shared_memory.SharedMemory(name=name)
+            # the submitting process owns (and unlinks) the block, before Python 3.13 attaching
+            # registers it with this process' resource tracker too, which unlinks it again at exit
+            resource_tracker.unregister(block._name, "shared_memory")
+            blocks.append(block)
+            if shape is None:
+                args[i] = bytes(block.buf[: int(dtype)])  # dtype holds the length for bytes
+            else:
+                array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+                array.flags.writeable = False
+                args[i] = array
+        return fn(*args)
+    finally:
+        del args
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                pass  # fn kept a view around, the mapping goes away with it
+
+
+class VisionService(Executor):
+    def __init__(self, max_workers: Optional[int] = None, min_shared_size: int = 64 * 1024):
+        if max_workers is None:
+            # leave a core for the Qt UI thread and the I/O threads
+            max_workers = max(1, (os.cpu_count() or 2) - 1)
+        self.max_workers = max_workers
+        self.min_shared_size = min_shared_size  # smaller arguments are cheaper to pickle
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_warm_up)
+
+    def warm_up(self, wait: bool = True) -> None:
+        """Starts every worker now instead of on the first submit."""
+        futures = [self._executor.submit(_warm_up) for _ in range(self.max_workers)]
+        if wait:
+            for future in futures:
+                future.result()
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        blocks = []
+        shared: dict[int, _Shared] = {}
+        try:
+            for i, arg in enumerate(args):
+                if isinstance(arg, (bytes, bytearray)) and len(arg) >= self.min_shared_size:
+                    block = shared_memory.SharedMemory(create=True, size=len(arg))
+                    block.buf[: len(arg)] = arg
+                    shared[i] = (block.name, None, str(len(arg)))
+                elif isinstance(arg, np.ndarray) and arg.nbytes >= self.min_shared_size:
+                    block = shared_memory.SharedMemory(create=True, size=arg.nbytes)
+                    np.ndarray(arg.shape, dtype=arg.dtype, buffer=block.buf)[...] = arg
+                    shared[i] = (block.name, arg.shape, arg.dtype.str)
+                else:
+                    continue
+                blocks.append(block)
+
+            args = tuple(None if i in shared else arg for i, arg in enumerate(args))
+            if kwargs:
+                fn = partial(fn, **kwargs)
+            future = self._executor.submit(_run_shared, fn, args, shared)
+        except BaseException:
+            _release(blocks)
+            raise
+
+        future.add_done_callback(lambda _: _release(blocks))
+        return future
+
+    def run(self, fn: Callable, *args, timeout: Optional[float] = None) -> Any:
+        return self.submit(fn, *args).result(timeout)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+def _release(blocks: list[shared_memory.SharedMemory]) -> None:
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def get_service() -> VisionService:
+    """The app's vision service, started on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = VisionService()
+        return _service
+
+
+def shutdown_service() -> None:
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.shutdown(wait=False, cancel_futures=True)
+            _service = None
@@ -3,7 +3,7 @@ import { APIError, SchemaError } from "./error";
 import {
   ConnectionState,
   getConnectionStateResponse,
-  SendImageDirective,
+  SendImageResponse,
   sendImageResponse,
 } from "./model";
 
@@ -92,7 +92,7 @@ export async function sendImage(
   connectionId: string,
   state: ConnectionState,
   imageBase64: string,
-): Promise<SendImageDirective> {
+): Promise<SendImageResponse> {
   try {
     const formData = new FormData();
     formData.append("image_base64", imageBase64);
@@ -120,7 +120,7 @@ export async function sendImage(
       throw new SchemaError(response, json, result.error);
     }
 
-    return result.data.directive;
+    return result.data;
   } catch (error) {
     console.error("Error sending image:", error);
     throw error;
@@ -13,9 +13,19 @@ export const getConnectionStateResponse = z.object({
   state: connectionState,
 });
 
-export const sendImageDirective = z.enum(["more_images", "next_state"]);
+// move: the image was dropped as a near-duplicate of a recent one, the camera should move
+// slow_down / pause: the image was turned away (rate limit / desktop behind), wait retry_after seconds
+export const sendImageDirective = z.enum([
+  "more_images",
+  "next_state",
+  "move",
+  "slow_down",
+  "pause",
+]);
 export type SendImageDirective = z.infer<typeof sendImageDirective>;
 
 export const sendImageResponse = z.object({
   directive: sendImageDirective,
+  retry_after: z.number().optional(),
 });
+export type SendImageResponse = z.infer<typeof sendImageResponse>;
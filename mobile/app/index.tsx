@@ -14,7 +14,7 @@ import { Pressable, StyleSheet, View, Text, Modal } from "react-native";
 import tinycolor from "tinycolor2";
 import connectionIDRegex from "@/constants/ConnectionIDRegex";
 import * as api from "@/api";
-import { ConnectionState } from "@/api/model";
+import { ConnectionState, SendImageResponse } from "@/api/model";
 import { useAppVisible } from "@/hooks/useAppVisible";
 
 export default function Index() {
@@ -26,6 +26,7 @@ export default function Index() {
   const [scanningQR, setScanningQR] = useState(true);
   const [connectionId, setConnectionId] = useState<string | null>(null);
   const [appState, setAppState] = useState<ConnectionState>("new");
+  const [hint, setHint] = useState<string | null>(null);
   const isAppVisible = useAppVisible();
 
   useEffect(() => {
@@ -54,8 +55,15 @@ export default function Index() {
           clearInterval(interval);
         }
       }, 500);
-    } else if (appState === "calibrating") {
+    } else if (appState === "calibrating" || appState === "organizing") {
+      // the same capture loop for both stages, the desktop moves the connection on
+      const state = appState;
+      // the bridge asks to hold off when the phone sends too fast or the desktop fell behind
+      let resumeAt = 0;
       const interval = setInterval(async () => {
+        if (Date.now() < resumeAt) {
+          return;
+        }
         const picture = await cameraRef.current?.takePictureAsync({
           base64: true,
           // fastMode: true,
@@ -69,17 +77,30 @@ export default function Index() {
           console.error("Failed to take picture");
         }
 
-        const directive = await api.sendImage(
-          connectionId!,
-          "calibrating",
-          picture!.base64!,
-        );
+        let response: SendImageResponse;
+        try {
+          response = await api.sendImage(connectionId!, state, picture!.base64!);
+        } catch {
+          // the desktop ends the connection once it has what it needs, uploads are refused from then on
+          const current = await api.getConnectionState(connectionId!).catch(() => null);
+          if (current === "done") {
+            setHint(null);
+            setAppState("done");
+            clearInterval(interval);
+          }
+          return;
+        }
+
+        const { directive, retry_after } = response;
+        setHint(directive === "move" ? "Move your phone a little" : null);
+        if (directive === "slow_down" || directive === "pause") {
+          resumeAt = Date.now() + (retry_after ?? 1) * 1000;
+        }
         if (directive === "next_state") {
-          setAppState("organizing");
+          setAppState(state === "calibrating" ? "organizing" : "done");
           clearInterval(interval);
         }
       }, 1500);
-    } else if (appState === "organizing") {
     }
   }, [appState]);
 
@@ -153,6 +174,11 @@ export default function Index() {
           </ThemedText>
         </ThemedView>
       </Modal>
+      {hint && (
+        <View style={styles.hintContainer}>
+          <ThemedText type="subtitle">{hint}</ThemedText>
+        </View>
+      )}
       <View style={styles.shutterContainer}>
         <Pressable onPress={toggleFacing}>
           <FontAwesome6 name="rotate-left" size={32} color="white" />
@@ -183,6 +209,12 @@ const styles = StyleSheet.create({
     justifyContent: "space-between",
     paddingHorizontal: 30,
   },
+  hintContainer: {
+    position: "absolute",
+    top: 80,
+    width: "100%",
+    alignItems: "center",
+  },
   shutterBtn: {
     backgroundColor: "transparent",
     borderWidth: 5,